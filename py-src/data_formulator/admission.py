@@ -0,0 +1,222 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from collections import OrderedDict, deque
+from functools import wraps
+import math
+import os
+import threading
+import time
+
+import flask
+from flask import request
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# agent requests running at once in this process, 0 disables admission control
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", 32))
+ADMISSION_MAX_ACTIVE_PER_CLIENT = int(os.getenv("ADMISSION_MAX_ACTIVE_PER_CLIENT", 4))
+# waiting requests, beyond that (or after waiting ADMISSION_MAX_WAIT seconds) requests are rejected with 503 + Retry-After
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 128))
+ADMISSION_MAX_QUEUE_PER_CLIENT = int(os.getenv("ADMISSION_MAX_QUEUE_PER_CLIENT", 16))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 60))
+# identify clients by the first X-Forwarded-For address (only when behind a trusted proxy) instead of the peer address
+ADMISSION_TRUST_FORWARDED_FOR = os.getenv("ADMISSION_TRUST_FORWARDED_FOR", "false").lower() == "true"
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"server busy ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission(object):
+    """an admitted request, release() frees its slot (releasing twice is harmless)"""
+
+    def __init__(self, controller, client_id):
+        self.controller = controller
+        self.client_id = client_id
+        self.admitted_at = time.time()
+        self.released = False
+
+    def release(self):
+        self.controller._release(self)
+
+
+class Waiter(object):
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.enqueued_at = time.time()
+        self.event = threading.Event()
+        self.admission = None
+
+
+class AdmissionController(object):
+    """Caps the number of concurrently running requests, globally and per client. Requests over the caps wait in
+    per-client FIFO queues, freed slots go to the waiting clients in round-robin order so that a client with many
+    queued requests cannot starve the others. Requests are rejected when the queue is full or after max_wait seconds."""
+
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, max_active_per_client=ADMISSION_MAX_ACTIVE_PER_CLIENT,
+                 max_queue=ADMISSION_MAX_QUEUE, max_queue_per_client=ADMISSION_MAX_QUEUE_PER_CLIENT, max_wait=ADMISSION_MAX_WAIT):
+        self.max_active = max_active
+        self.max_active_per_client = max_active_per_client
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.max_wait = max_wait
+
+        self.lock = threading.Lock()
+        self.active = {} # client id -> number of running requests
+        self.num_active = 0
+        self.queues = OrderedDict() # client id -> deque of waiters, in round-robin order
+        self.num_waiting = 0
+
+        self.num_admitted = 0
+        self.num_rejected = {"queue_full": 0, "timeout": 0}
+        self.num_queued = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # moving average of how long requests hold their slot, for Retry-After
+        self.avg_service_seconds = 5.0
+
+    def _can_run(self, client_id):
+        return self.num_active < self.max_active and self.active.get(client_id, 0) < self.max_active_per_client
+
+    def _admit(self, client_id):
+        self.num_active += 1
+        self.active[client_id] = self.active.get(client_id, 0) + 1
+        self.num_admitted += 1
+        return Admission(self, client_id)
+
+    def _dispatch(self):
+        """hand free slots to waiting requests, one client at a time in round-robin order"""
+        progress = True
+        while progress and self.num_active < self.max_active and self.num_waiting > 0:
+            progress = False
+            for client_id in list(self.queues):
+                if not self._can_run(client_id):
+                    continue
+                queue = self.queues.pop(client_id)
+                waiter = queue.popleft()
+                if len(queue) > 0:
+                    # back of the line
+                    self.queues[client_id] = queue
+                self.num_waiting -= 1
+                waiter.admission = self._admit(client_id)
+                waiter.event.set()
+                progress = True
+                if self.num_active >= self.max_active:
+                    break
+
+    def _retry_after(self):
+        return max(1, math.ceil(self.avg_service_seconds * (self.num_waiting + 1) / max(1, self.max_active)))
+
+    def _reject(self, reason):
+        self.num_rejected[reason] += 1
+        retry_after = self._retry_after()
+        logger.warning(f"admission rejected ({reason}): {self.num_active} active, {self.num_waiting} waiting, retry after {retry_after}s")
+        return AdmissionRejected(reason, retry_after)
+
+    def acquire(self, client_id):
+        """wait for a slot, returns an Admission or raises AdmissionRejected"""
+        with self.lock:
+            # waiting requests of other clients are all blocked by their per-client cap (see _dispatch)
+            if client_id not in self.queues and self._can_run(client_id):
+                return self._admit(client_id)
+            if self.num_waiting >= self.max_queue or len(self.queues.get(client_id, [])) >= self.max_queue_per_client:
+                raise self._reject("queue_full")
+            waiter = Waiter(client_id)
+            self.queues.setdefault(client_id, deque()).append(waiter)
+            self.num_waiting += 1
+            self.num_queued += 1
+
+        waiter.event.wait(self.max_wait)
+
+        with self.lock:
+            wait_seconds = time.time() - waiter.enqueued_at
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            if waiter.admission is not None:
+                return waiter.admission
+            queue = self.queues[client_id]
+            queue.remove(waiter)
+            if len(queue) == 0:
+                del self.queues[client_id]
+            self.num_waiting -= 1
+            raise self._reject("timeout")
+
+    def _release(self, admission):
+        with self.lock:
+            if admission.released:
+                return
+            admission.released = True
+            self.num_active -= 1
+            self.active[admission.client_id] -= 1
+            if self.active[admission.client_id] == 0:
+                del self.active[admission.client_id]
+            self.avg_service_seconds = 0.9 * self.avg_service_seconds + 0.1 * (time.time() - admission.admitted_at)
+            self._dispatch()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": self.num_active,
+                "waiting": self.num_waiting,
+                "active_clients": len(self.active),
+                "waiting_clients": len(self.queues),
+                "admitted": self.num_admitted,
+                "rejected": dict(self.num_rejected),
+                "queued": self.num_queued,
+                "avg_wait_seconds": self.total_wait_seconds / self.num_queued if self.num_queued > 0 else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+                "avg_service_seconds": self.avg_service_seconds,
+                "limits": {
+                    "max_active": self.max_active,
+                    "max_active_per_client": self.max_active_per_client,
+                    "max_queue": self.max_queue,
+                    "max_queue_per_client": self.max_queue_per_client,
+                    "max_wait": self.max_wait,
+                },
+            }
+
+
+admission_controller = AdmissionController()
+
+
+def get_client_id():
+    if ADMISSION_TRUST_FORWARDED_FOR and request.headers.get("X-Forwarded-For"):
+        return request.headers["X-Forwarded-For"].split(",")[0].strip()
+    return request.remote_addr or "unknown"
+
+
+def admission_controlled(view):
+    """route decorator: run the view only once the admission controller lets the request in,
+    the slot is held until the response is closed (so streamed responses hold it while they stream)"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMISSION_MAX_ACTIVE <= 0 or request.method == "OPTIONS":
+            return view(*args, **kwargs)
+
+        try:
+            admission = admission_controller.acquire(get_client_id())
+        except AdmissionRejected as err:
+            response = flask.jsonify({ "status": "error", "message": str(err) })
+            response.status_code = 503
+            response.headers["Retry-After"] = str(err.retry_after)
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            return response
+
+        try:
+            response = flask.make_response(view(*args, **kwargs))
+        except BaseException:
+            admission.release()
+            raise
+        response.call_on_close(admission.release)
+        return response
+
+    return wrapper
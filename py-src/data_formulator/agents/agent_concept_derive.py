@@ -3,12 +3,11 @@
 
 import os
 import sys
-import pandas as pd
 
 APP_ROOT = os.path.abspath('..')
 sys.path.append(os.path.abspath(APP_ROOT))
 
-from data_formulator.agents.agent_utils import generate_data_summary, field_name_to_ts_variable_name, extract_code_from_gpt_response, infer_ts_datatype
+from data_formulator.agents.agent_utils import generate_data_summary, field_name_to_ts_variable_name, extract_code_from_gpt_response, get_ts_datatypes
 
 import logging
 
@@ -176,7 +175,8 @@ class ConceptDeriveAgent(object):
         
         data_summary = generate_data_summary([input_table], include_data_samples=True)
 
-        input_fields_info = [{"name": name, "type": infer_ts_datatype(pd.DataFrame(input_table['rows']), name)} for name in input_fields]
+        ts_datatypes = get_ts_datatypes(input_table)
+        input_fields_info = [{"name": name, "type": ts_datatypes.get(name, "any")} for name in input_fields]
         
         arg_string = ", ".join([f"{field_name_to_ts_variable_name(field['name'])} : {field['type']}" for field in input_fields_info])
         code_template = f"```typescript\n//{description}\n({arg_string}) => {{\n    // complete code here\n    return {field_name_to_ts_variable_name(output_field)}\n}}\n```"
@@ -4,7 +4,7 @@
 import json
 import pandas as pd
 
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response, field_name_to_ts_variable_name, infer_ts_datatype
+from data_formulator.agents.agent_utils import scan_response, generate_data_summary, field_name_to_ts_variable_name, infer_ts_datatype
 
 import logging
 
@@ -136,8 +136,9 @@ class DataCleanAgent(object):
             logger.info("\n=== Python Data Clean Agent ===>\n")
             logger.info(choice.message.content + "\n")
 
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "csv")
-            reason_blocks = extract_json_objects(choice.message.content + "\n")
+            scanned = scan_response(choice.message.content + "\n")
+            code_blocks = scanned.code("csv")
+            reason_blocks = scanned.json_objects
 
             if len(code_blocks) > 0:
                 result = {
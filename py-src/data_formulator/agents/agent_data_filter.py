@@ -1,15 +1,18 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import json
+import os
 
-from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response, results_as_records
 import data_formulator.py_sandbox as py_sandbox
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# tables with at least this many rows are filtered with a whole-frame filter_df(df) function
+FRAME_FILTER_MIN_ROWS = int(os.getenv("FRAME_FILTER_MIN_ROWS", 1000))
+
 
 SYSTEM_PROMPT = '''You are a data scientist to help user to filter data based on user description.
 Your job is to write a python function that will be applied to filter the input data, based on on input data summary, instruction and output column name.
@@ -122,11 +125,113 @@ def filter_row(row, df):
 ```
 '''
 
+SYSTEM_PROMPT_FRAME = '''You are a data scientist to help user to filter data based on user description.
+Your job is to write a python function that will be applied to filter the input data, based on on input data summary, instruction and output column name.
+Complete a python function based off [TEMPLATE], and [CONTEXT], [GOAL] provided for each task, 
+    the function's input argument is df (the full input dataset), 
+    and the output is a boolean Series (one value per row of df, aligned with df's index) deciding whether each row will be kept (True) or removed (False).
+The function will be applied once to df to generate the filtered dataset later, so use vectorized pandas operations over whole columns and compute any aggregate (e.g., quantiles, means) only once.
+The function should be as simple as possible, return the filter_df function only. 
+
+[TEMPLATE]
+
+```python
+import re
+import datetime
+import pandas as pd
+import numpy
+
+def filter_df(df):
+    # complete code here, return a boolean mask deciding which rows of df satisfy the filter condition
+```
+
+For example:
+
+[CONTEXT]
+
+Here are our datasets, here are their field summaries and samples:
+
+table_0 (us_covid_cases) fields:
+	Date -- type: object, values: 1/1/2021, 1/1/2022, 1/1/2023, ..., 9/8/2022, 9/9/2020, 9/9/2021, 9/9/2022
+	Cases -- type: int64, values: -23999, -14195, -6940, ..., 1018935, 1032159, 1178403, 1433977
+
+table_0 (us_covid_cases) sample:
+```
+|Date|Cases
+0|1/21/2020|1
+1|1/22/2020|0
+2|1/23/2020|0
+3|1/24/2020|1
+4|1/25/2020|1
+......
+```
+
+[GOAL]
+
+include only summer months
+
+[OUTPUT]
+
+```python
+import re  
+import datetime  
+import pandas as pd  
+import numpy  
+  
+
+def filter_df(df):  
+    dates = pd.to_datetime(df['Date'], format='%m/%d/%Y')  
+    return dates.dt.month.isin([6, 7, 8])  
+```
+
+[CONTEXT]
+
+Here are our datasets, here are their field summaries and samples:
+
+table_0 (student_exam) fields:
+	student -- type: int64, values: 1, 2, 3, ..., 997, 998, 999, 1000
+	major -- type: object, values: liberal arts, science
+	math -- type: int64, values: 0, 8, 18, ..., 97, 98, 99, 100
+	reading -- type: int64, values: 17, 23, 24, ..., 96, 97, 99, 100
+	writing -- type: int64, values: 10, 15, 19, ..., 97, 98, 99, 100
+
+table_0 (student_exam) sample:
+
+```
+|student|major|math|reading|writing
+0|1|liberal arts|72|72|74
+1|2|liberal arts|69|90|88
+2|3|liberal arts|90|95|93
+3|4|science|47|57|44
+4|5|science|76|78|75
+......
+```
+
+[GOAL]
+
+Show only students whose total scores are among top 30% of all students
+
+[OUTPUT]
+
+```python
+import re    
+import datetime    
+import pandas as pd    
+import numpy    
+    
+  
+def filter_df(df):    
+    total_score = df['math'] + df['reading'] + df['writing']    
+    return total_score >= total_score.quantile(q=0.7)    
+```
+'''
+
 
 class DataFilterAgent(object):
 
-    def __init__(self, client):
+    def __init__(self, client, frame_filter_min_rows=FRAME_FILTER_MIN_ROWS):
         self.client = client
+        self.frame_filter_min_rows = frame_filter_min_rows
 
     def process_gpt_result(self, input_table, response, messages):
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
@@ -145,8 +250,7 @@ class DataFilterAgent(object):
                     result =  py_sandbox.run_filter_data_in_sandbox2020(code_str, input_table['rows'])
 
                     if result['status'] == 'ok':
-                        new_data = json.loads(result['content'])
-                        result['content'] = new_data
+                        logger.info(f"filter function executed with strategy: {result['strategy']}")
                     else:
                         logger.info(result['content'])
                     result['code'] = code_str
@@ -160,7 +264,7 @@ class DataFilterAgent(object):
             result['agent'] = 'DataFilterAgent'
             candidates.append(result)
 
-        return candidates
+        return results_as_records(candidates)
 
     def run(self, input_table, description):
         """derive a new concept based on input table, input fields, and output field name, (and description)
@@ -172,7 +276,14 @@ class DataFilterAgent(object):
 
         logger.info(user_query)
 
-        messages = [{"role":"system", "content": SYSTEM_PROMPT},
+        # a row-wise filter_row(row, df) tends to recompute whole-table aggregates for every row, 
+        # large tables ask for a whole-frame filter_df(df) instead (the sandbox runs either contract)
+        if len(input_table['rows']) >= self.frame_filter_min_rows:
+            system_prompt = SYSTEM_PROMPT_FRAME
+        else:
+            system_prompt = SYSTEM_PROMPT
+
+        messages = [{"role":"system", "content": system_prompt},
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
@@ -1,9 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import json
-
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, results_as_records, scan_response, ResponseStreamHandler
 from data_formulator.agents.agent_data_transform_v2 import completion_response_wrapper
 
 import data_formulator.py_sandbox as py_sandbox
@@ -130,9 +128,27 @@ def transform_data(df):
 
 class DataRecAgent(object):
 
-    def __init__(self, client, system_prompt=None):
+    def __init__(self, client, system_prompt=None, on_event=None, records=True):
         self.client = client
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
+        self.on_event = on_event
+        # results' content as json records, or (records=False, used by the app) as the sandbox's dataframes
+        self.records = records
+
+    def emit(self, event, **payload):
+        if self.on_event is not None:
+            self.on_event(event, payload)
+
+    def request_completion(self, messages, n):
+        self.emit("prompt", model=self.client.model, num_messages=len(messages), n=n)
+        if self.on_event is None:
+            return completion_response_wrapper(self.client, messages, n)
+
+        # tokens, the refined goal and the code of each choice are reported while they stream in
+        stream_handler = ResponseStreamHandler(self.emit, "python")
+        response = completion_response_wrapper(self.client, messages, n, stream_handler)
+        stream_handler.finish()
+        return response
 
     def process_gpt_response(self, input_tables, messages, response):
         """process gpt response to handle execution"""
@@ -140,7 +156,7 @@ class DataRecAgent(object):
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
 
         if isinstance(response, Exception):
-            result = {'status': 'other error', 'content': str(response.body)}
+            result = {'status': 'other error', 'content': str(getattr(response, 'body', response))}
             return [result]
         
         candidates = []
@@ -149,30 +165,33 @@ class DataRecAgent(object):
             logger.info("\n=== Data recommendation result ===>\n")
             logger.info(choice.message.content + "\n")
             
-            json_blocks = extract_json_objects(choice.message.content + "\n")
+            scanned = scan_response(choice.message.content + "\n")
+            json_blocks = scanned.json_objects
             if len(json_blocks) > 0:
                 refined_goal = json_blocks[0]
             else:
                 refined_goal = { 'mode': "", 'recommendation': "", 'output_fields': [], 'visualization_fields': [], }
 
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
+            code_blocks = scanned.code("python")
 
             if len(code_blocks) > 0:
                 code_str = code_blocks[-1]
 
                 try:
+                    self.emit("sandbox_start", candidate=choice.index)
                     result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables])
                     result['code'] = code_str
 
-                    if result['status'] == 'ok':
-                        result['content'] = json.loads(result['content'])
-                    else:
+                    if result['status'] != 'ok':
                         logger.info(result['content'])
                 except Exception as e:
                     logger.warning('other error:')
                     error_message = traceback.format_exc()
                     logger.warning(error_message)
                     result = {'status': 'other error', 'code': code_str, 'content': f"Unexpected error: {error_message}"}
+                self.emit("sandbox_result", candidate=choice.index, status=result['status'],
+                          num_rows=len(result['content']) if result['status'] == 'ok' else None,
+                          error=result['content'] if result['status'] != 'ok' else None)
             else:
                 result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
             
@@ -189,7 +208,7 @@ class DataRecAgent(object):
                 else:
                     logger.info(f"## {key}:\n{value}")
 
-        return candidates
+        return results_as_records(candidates) if self.records else candidates
     
 
     def run(self, input_tables, description, n=1):
@@ -203,7 +222,7 @@ class DataRecAgent(object):
         messages = [{"role":"system", "content": self.system_prompt},
                     {"role":"user","content": user_query}]
         
-        response = completion_response_wrapper(self.client, messages, n)
+        response = self.request_completion(messages, n)
         
         return self.process_gpt_response(input_tables, messages, response)
         
@@ -215,6 +234,6 @@ class DataRecAgent(object):
 
         messages = [*dialog, {"role":"user", "content": f"Update: \n\n{new_instruction}"}]
 
-        response = completion_response_wrapper(self.client, messages, n)
+        response = self.request_completion(messages, n)
 
         return self.process_gpt_response(input_tables, messages, response)
\ No newline at end of file
@@ -1,10 +1,13 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import concurrent.futures
 import json
 import sys
+import threading
 
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, get_table_profile, results_as_records, scan_response, ResponseStreamHandler, dedup_data_transform_candidates
+from data_formulator.agents.prompt_builder import PromptBuilder, SUMMARY_SAMPLE_SIZES, trim_value_samples, drop_low_relevance_fields, condense_older_turns
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -184,10 +187,10 @@ def transform_data(df):
 ```
 '''
 
-def completion_response_wrapper(client, messages, n):
+def completion_response_wrapper(client, messages, n, on_token=None):
     ### wrapper for completion response, especially handling errors
     try:
-        response = client.get_completion(messages = messages)
+        response = client.get_completion(messages = messages, on_token = on_token, n = n)
     except Exception as e:
         response = e
 
@@ -196,58 +199,111 @@ def completion_response_wrapper(client, messages, n):
 
 class DataTransformationAgentV2(object):
 
-    def __init__(self, client, system_prompt=None):
+    def __init__(self, client, system_prompt=None, on_event=None, records=True):
         self.client = client
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
+        # optional progress callback on_event(event, payload), used to stream progress to the client
+        self.on_event = on_event
+        # results' content as json records, or (records=False, used by the app) as the sandbox's dataframes
+        self.records = records
+
+    def emit(self, event, **payload):
+        if self.on_event is not None:
+            self.on_event(event, payload)
+
+    def request_completion(self, messages, n):
+        """yields the choices of the completion as soon as each of them is complete"""
+        self.emit("prompt", model=self.client.model, num_messages=len(messages), n=n)
+        if self.on_event is None:
+            yield from self.client.iter_completions(messages, n=n)
+            return
+
+        # tokens, the refined goal and the code of each choice are reported while they stream in
+        stream_handler = ResponseStreamHandler(self.emit, "python")
+        try:
+            for choice in self.client.iter_completions(messages, on_token=stream_handler, n=n):
+                stream_handler.finish_choice(choice.index)
+                yield choice
+        finally:
+            stream_handler.finish()
+
+    def process_choice(self, input_tables, messages, choice):
+        """extract the refined goal and code from one choice and run the code"""
+
+        logger.info("=== Data transformation result ===>")
+        logger.info(choice.message.content + "\n")
+        
+        scanned = scan_response(choice.message.content + "\n")
+        json_blocks = scanned.json_objects
+        if len(json_blocks) > 0:
+            refined_goal = json_blocks[0]
+        else:
+            refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
+
+        code_blocks = scanned.code("python")
+
+        if len(code_blocks) > 0:
+            code_str = code_blocks[-1]
+
+            try:
+                self.emit("sandbox_start", candidate=choice.index)
+                result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables])
+                result['code'] = code_str
+
+                # the sandbox returns the result as a dataframe, it is only serialized when the response is sent
+                if result['status'] != 'ok':
+                    logger.info(result['content'])
+            except Exception as e:
+                logger.warning('Error occurred during code execution:')
+                error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
+                logger.warning(error_message)
+                result = {'status': 'error', 'code': code_str, 'content': error_message}
+            self.emit("sandbox_result", candidate=choice.index, status=result['status'],
+                      num_rows=len(result['content']) if result['status'] == 'ok' else None,
+                      error=result['content'] if result['status'] != 'ok' else None)
+        else:
+            result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
+        
+        result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
+        result['agent'] = 'DataTransformationAgent'
+        result['refined_goal'] = refined_goal
+        return result
 
-    def process_gpt_response(self, input_tables, messages, response):
-        """process gpt response to handle execution"""
-
-        #log = {'messages': messages, 'response': response.model_dump(mode='json')}
-        #logger.info("=== prompt_filter_results ===>")
-        #logger.info(response.prompt_filter_results)
+    def process_gpt_response(self, input_tables, messages, choices):
+        """process gpt response to handle execution: the code of each choice runs in its own sandbox as soon as the choice
+        is complete, candidates are ordered by completion time and those producing the same table are deduplicated. 
+        If none of them succeeds, the failed candidates are returned (so that the first one can be repaired)"""
 
-        if isinstance(response, Exception):
-            result = {'status': 'other error', 'content': str(response.body)}
-            return [result]
-        
         candidates = []
-        for choice in response.choices:
-            logger.info("=== Data transformation result ===>")
-            logger.info(choice.message.content + "\n")
-            
-            json_blocks = extract_json_objects(choice.message.content + "\n")
-            if len(json_blocks) > 0:
-                refined_goal = json_blocks[0]
-            else:
-                refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
-
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
-
-            if len(code_blocks) > 0:
-                code_str = code_blocks[-1]
-
-                try:
-                    result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables])
-                    result['code'] = code_str
-
-                    if result['status'] == 'ok':
-                        # parse the content
-                        result['content'] = json.loads(result['content'])
-                    else:
-                        logger.info(result['content'])
-                except Exception as e:
-                    logger.warning('Error occurred during code execution:')
-                    error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
-                    logger.warning(error_message)
-                    result = {'status': 'error', 'code': code_str, 'content': error_message}
-            else:
-                result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
-            
-            result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
-            result['agent'] = 'DataTransformationAgent'
-            result['refined_goal'] = refined_goal
-            candidates.append(result)
+        candidates_lock = threading.Lock()
+
+        def process(choice):
+            result = self.process_choice(input_tables, messages, choice)
+            with candidates_lock:
+                if result['status'] == 'ok' and all(c['status'] != 'ok' for c in candidates):
+                    # the first working candidate is sent right away, the others follow with the final result
+                    self.emit("candidate", candidate=choice.index, result=result)
+                candidates.append(result)
+
+        error = None
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            try:
+                for choice in choices:
+                    futures.append(executor.submit(process, choice))
+            except Exception as e:
+                error = e
+        for future in futures:
+            future.result()
+
+        if error is not None:
+            if len(futures) == 0:
+                return [{'status': 'other error', 'content': str(getattr(error, 'body', error))}]
+            logger.warning(f"completion failed after {len(futures)} choices: {error}")
+
+        ok_candidates = dedup_data_transform_candidates(candidates)
+        if len(ok_candidates) > 0:
+            candidates = ok_candidates
 
         logger.info("=== Transform Candidates ===>")
         for candidate in candidates:
@@ -257,38 +313,53 @@ class DataTransformationAgentV2(object):
                 else:
                     logger.info(f"## {key}:\n{value}")
 
-        return candidates
+        return results_as_records(candidates) if self.records else candidates
 
 
     def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1):
 
-        if len(prev_messages) > 0:
-            logger.info("=== Previous messages ===>")
-            formatted_prev_messages = ""
-            for m in prev_messages:
-                if m['role'] != 'system':
-                    formatted_prev_messages += f"{m['role']}: \n\n\t{m['content']}\n\n"
-            logger.info(formatted_prev_messages)
-            prev_messages = [{"role": "user", "content": '[Previous Messages] Here are the previous messages for your reference:\n\n' + formatted_prev_messages}]
-
-        data_summary = generate_data_summary(input_tables, include_data_samples=True)
+        prev_turns = [m for m in prev_messages if m['role'] != 'system']
 
         goal = {
             "instruction": description,
             "visualization_fields": expected_fields
         }
 
-        user_query = f"[CONTEXT]\n\n{data_summary}\n\n[GOAL]\n\n{json.dumps(goal, indent=4)}\n\n[OUTPUT]\n"
+        # tables are profiled once, shrink steps only cut down the profiles' sample values
+        profiles = [get_table_profile(table) for table in input_tables]
+
+        def render(state):
+            field_sample_size, num_sample_rows = SUMMARY_SAMPLE_SIZES[state["sample_level"]]
+            data_summary = generate_data_summary(input_tables, include_data_samples=True, field_sample_size=field_sample_size,
+                                                 num_sample_rows=num_sample_rows, omitted_fields=state["omitted_fields"], profiles=profiles)
+
+            context_messages = []
+            if len(state["turns"]) > 0:
+                formatted_prev_messages = ""
+                for m in state["turns"]:
+                    formatted_prev_messages += f"{m['role']}: \n\n\t{m['content']}\n\n"
+                context_messages = [{"role": "user", "content": '[Previous Messages] Here are the previous messages for your reference:\n\n' + formatted_prev_messages}]
 
-        logger.info(user_query)
+            user_query = f"[CONTEXT]\n\n{data_summary}\n\n[GOAL]\n\n{json.dumps(goal, indent=4)}\n\n[OUTPUT]\n"
 
-        messages = [{"role":"system", "content": self.system_prompt},
-                    *prev_messages,
+            return [{"role":"system", "content": self.system_prompt},
+                    *context_messages,
                     {"role":"user","content": user_query}]
-        
-        response = completion_response_wrapper(self.client, messages, n)
 
-        return self.process_gpt_response(input_tables, messages, response)
+        # when over the token budget: trim value samples, then omit fields the request does not mention, then condense older turns
+        relevance_context = " ".join([description, *expected_fields, *[m['content'] for m in prev_turns]])
+        state = {"sample_level": 0, "omitted_fields": {}, "turns": list(prev_turns)}
+        messages = PromptBuilder(self.client.model).build("DataTransformationAgentV2", state, render, 
+                                                          [trim_value_samples, drop_low_relevance_fields(input_tables, relevance_context, profiles), condense_older_turns])
+
+        if len(prev_turns) > 0:
+            logger.info("=== Previous messages ===>")
+            logger.info(messages[1]['content'])
+        logger.info(messages[-1]['content'])
+
+        choices = self.request_completion(messages, n)
+
+        return self.process_gpt_response(input_tables, messages, choices)
         
 
     def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1):
@@ -303,11 +374,31 @@ class DataTransformationAgentV2(object):
 
         #logger.info(dialog)
 
-        updated_dialog = [{"role":"system", "content": self.system_prompt}, *dialog[1:]]
-
-        messages = [*updated_dialog, {"role":"user", 
-                              "content": f"Update the code above based on the following instruction:\n\n{json.dumps(goal, indent=4)}"}]
-
-        response = completion_response_wrapper(self.client, messages, n)
-
-        return self.process_gpt_response(input_tables, messages, response)
+        instruction = {"role":"user", "content": f"Update the code above based on the following instruction:\n\n{json.dumps(goal, indent=4)}"}
+
+        # the dialog's data summary (from run) is regenerated from the tables' profiles once the budget requires shrinking it
+        summary_turn = next((m for m in dialog[1:] if m['role'] == 'user' and m['content'].startswith("[CONTEXT]") 
+                             and "\n\n[GOAL]" in m['content']), None)
+        profiles = [get_table_profile(table) for table in input_tables] if summary_turn is not None else []
+
+        def render(state):
+            turns = state["turns"]
+            if summary_turn is not None and (state["sample_level"] > 0 or len(state["omitted_fields"]) > 0):
+                field_sample_size, num_sample_rows = SUMMARY_SAMPLE_SIZES[state["sample_level"]]
+                data_summary = generate_data_summary(input_tables, include_data_samples=True, field_sample_size=field_sample_size,
+                                                     num_sample_rows=num_sample_rows, omitted_fields=state["omitted_fields"], profiles=profiles)
+                goal_section = summary_turn['content'].split("\n\n[GOAL]", 1)[1]
+                turns = [{**m, "content": f"[CONTEXT]\n\n{data_summary}\n\n[GOAL]{goal_section}"} if m is summary_turn else m for m in turns]
+            return [{"role":"system", "content": self.system_prompt}, *turns, instruction]
+
+        # when over the token budget: trim value samples, then omit fields the instructions do not mention, then condense older turns
+        relevance_context = " ".join([new_instruction, *output_fields, *[m['content'] for m in dialog[1:]]])
+        state = {"sample_level": 0, "omitted_fields": {}, "turns": list(dialog[1:])}
+        shrink_steps = [condense_older_turns]
+        if summary_turn is not None:
+            shrink_steps = [trim_value_samples, drop_low_relevance_fields(input_tables, relevance_context, profiles), condense_older_turns]
+        messages = PromptBuilder(self.client.model).build("DataTransformationAgentV2.followup", state, render, shrink_steps)
+
+        choices = self.request_completion(messages, n)
+
+        return self.process_gpt_response(input_tables, messages, choices)
@@ -1,9 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import json
-
-from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response, results_as_records
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -144,10 +142,7 @@ class DataTransformationAgent(object):
                 try:
                     result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables])
 
-                    if result['status'] == 'ok':
-                        new_data = json.loads(result['content'])
-                        result['content'] = new_data
-                    else:
+                    if result['status'] != 'ok':
                         logger.info(result['content'])
                     result['code'] = code_str
                 except Exception as e:
@@ -162,7 +157,7 @@ class DataTransformationAgent(object):
             result['agent'] = 'DataTransformationAgent'
             candidates.append(result)
 
-        return candidates
+        return results_as_records(candidates)
     
     def try_enrich_output(self, input_tables, output_fields: list[str], candidates, log):
 
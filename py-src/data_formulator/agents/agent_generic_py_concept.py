@@ -1,9 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import json
-
-from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response, results_as_records
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -174,21 +172,9 @@ class GenericPyConceptDeriveAgent(object):
             if len(code_blocks) > 0:
                 code_str = code_blocks[-1]
                 try:
+                    result = py_sandbox.run_generic_derive_data_in_sandbox2020(code_str, [], output_field, input_table['rows'])
 
-                    exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
-app_func = lambda r: derive(r, df)
-df["{output_field}"] = df.apply(app_func, axis = 1)
-output = json.dumps(df.to_dict("records"))
-#print(output)
-'''
-
-                    result = py_sandbox.run_data_process_in_sandbox(code_str, input_table['rows'], exec_str)
-
-                    if result['status'] == 'ok':
-                        new_data = json.loads(result['content'])
-                        result['content'] = new_data
-                    else:
+                    if result['status'] != 'ok':
                         logger.info(result['content'])
                     result['code'] = code_str
                 except Exception as e:
@@ -203,7 +189,7 @@ output = json.dumps(df.to_dict("records"))
             result['agent'] = 'GenericPyConceptDeriveAgent'
             candidates.append(result)
 
-        return candidates
+        return results_as_records(candidates)
 
     def run(self, input_table, output_field, description):
         """derive a new concept based on input table, input fields, and output field name, (and description)
@@ -1,10 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import json
-import pandas as pd
-
-from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response, field_name_to_ts_variable_name, infer_ts_datatype
+from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response, results_as_records, field_name_to_ts_variable_name, get_ts_datatypes
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -140,7 +137,8 @@ class PyConceptDeriveAgent(object):
         
         data_summary = generate_data_summary([input_table], include_data_samples=True)
 
-        input_fields_info = [{"name": name, "type": infer_ts_datatype(pd.DataFrame(input_table['rows']), name)} for name in input_fields]
+        ts_datatypes = get_ts_datatypes(input_table)
+        input_fields_info = [{"name": name, "type": ts_datatypes.get(name, "any")} for name in input_fields]
         
         arg_string = ", ".join([f"{field_name_to_ts_variable_name(field['name'])}" for field in input_fields_info])
         code_template = f"""```python
@@ -180,8 +178,7 @@ def derive({arg_string}):
                     result =  py_sandbox.run_derive_data_in_sandbox2020(code_str, input_fields, output_field, input_table['rows'])
 
                     if result['status'] == 'ok':
-                        new_data = json.loads(result['content'])
-                        result['content'] = new_data
+                        logger.info(f"derive function executed with strategy: {result['strategy']}")
                     else:
                         print(result['content'])
                     result['code'] = code_str
@@ -197,4 +194,4 @@ def derive({arg_string}):
             result['agent'] = 'PyConceptDeriveAgent'
             candidates.append(result)
 
-        return candidates
\ No newline at end of file
+        return results_as_records(candidates)
\ No newline at end of file
@@ -3,6 +3,7 @@
 
 import json
 from data_formulator.agents.agent_utils import extract_json_objects
+from data_formulator.agents.prompt_builder import PromptBuilder
 
 import logging
 
@@ -70,17 +71,39 @@ class SortDataAgent(object):
 
     def run(self, name, values, n=1):
 
-        input_obj = {
-            'name': name,
-            'value': values
-        }
-
-        user_query = f"[INPUT]\n\n{json.dumps(input_obj)}\n\n[OUTPUT]"
-
-        logger.info(user_query)
-
-        messages = [{"role":"system", "content": SYSTEM_PROMPT},
+        def render(state):
+            input_obj = {
+                'name': name,
+                'value': state["values"][:state["num_values"]]
+            }
+            user_query = f"[INPUT]\n\n{json.dumps(input_obj)}\n\n[OUTPUT]"
+            return [{"role":"system", "content": SYSTEM_PROMPT},
                     {"role":"user","content": user_query}]
+
+        def drop_duplicate_values(state):
+            try:
+                unique_values = list(dict.fromkeys(state["values"]))
+            except TypeError:
+                return False
+            if len(unique_values) == len(state["values"]):
+                return False
+            state["values"] = unique_values
+            state["num_values"] = len(unique_values)
+            return True
+
+        def halve_values(state):
+            if state["num_values"] <= 1:
+                return False
+            state["num_values"] = state["num_values"] // 2
+            return True
+
+        # over the token budget duplicates are dropped first, then only the first values are sorted
+        # and the others are appended to the result unsorted
+        state = {"values": values, "num_values": len(values)}
+        messages = PromptBuilder(self.client.model).build("SortDataAgent", state, render, [drop_duplicate_values, halve_values])
+        omitted_values = state["values"][state["num_values"]:]
+
+        logger.info(messages[-1]['content'])
         
         ###### the part that calls open_ai
         response = self.client.get_completion(messages = messages)
@@ -103,6 +126,19 @@ class SortDataAgent(object):
                     result = {'status': 'ok', 'content': json_block}
                 except:
                     result = {'status': 'other error', 'content': 'unable to extract VegaLite script from response'}
+
+            if result['status'] == 'ok' and len(omitted_values) > 0 \
+                    and isinstance(result['content'], dict) and isinstance(result['content'].get('sorted_values'), list):
+                sorted_values = result['content']['sorted_values']
+                try:
+                    seen = set(sorted_values)
+                except TypeError:
+                    seen = sorted_values
+                result['content']['sorted_values'] = [*sorted_values, *[v for v in omitted_values if v not in seen]]
+
+            if len(omitted_values) > 0:
+                # only a prefix of the values was sorted by the model
+                result['truncated'] = True
             
             # individual dialog for the agent
             result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
@@ -1,8 +1,10 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import hashlib
 import json
 import keyword
+import os
 import pandas as pd
 import numpy as np
 
@@ -12,6 +14,13 @@ from pprint import pprint
 
 import re
 
+from data_formulator.agents.table_profiler import profile_field, profile_table, format_field_summary, shrink_field_profile
+from data_formulator.cache_utils import LRUCache
+
+# profiles of recently seen tables, shared by all agents and requests
+PROFILE_CACHE_MAX_ITEMS = int(os.getenv("PROFILE_CACHE_MAX_ITEMS", 256))
+table_profile_cache = LRUCache(max_items=PROFILE_CACHE_MAX_ITEMS)
+
 def string_to_py_varname(var_str): 
     var_name = re.sub('\W|^(?=\d)','_', var_str)
     if keyword.iskeyword(var_name):
@@ -58,112 +67,248 @@ def value_handling_func(val):
 
     return val
 
+def column_value_hashes(column):
+    """vectorized per-cell hashes of a column, values are made comparable as in value_handling_func:
+    numbers (and strings that parse as numbers) are compared as floats rounded to 5 decimals, other values by their string form"""
+    missing = column.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(column):
+        numbers = column.astype("float64")
+    elif column.dtype == object:
+        numbers = pd.to_numeric(column, errors="coerce")
+    else:
+        numbers = pd.Series(np.nan, index=column.index)
+
+    is_number = numbers.notna().to_numpy()
+    # + 0.0 folds -0.0 into 0.0
+    number_hashes = pd.util.hash_pandas_object(numbers.round(5).fillna(0) + 0.0, index=False).to_numpy()
+    if is_number.all():
+        hashes = number_hashes
+    else:
+        string_hashes = pd.util.hash_pandas_object(column.astype(str), index=False).to_numpy()
+        hashes = np.where(is_number, number_hashes, string_hashes)
+    return np.where(missing & ~is_number, np.uint64(0), hashes)
+
+
+def table_fingerprint(table):
+    """order-insensitive fingerprint of a table (a dataframe or json records): tables with the same columns
+    and the same multiset of rows get the same fingerprint regardless of row and column order"""
+    df = table if isinstance(table, pd.DataFrame) else pd.DataFrame(table)
+    columns = sorted(df.columns, key=str)
+
+    header_hash = hash(tuple(str(c) for c in columns))
+    if len(df) == 0 or len(columns) == 0:
+        return hash((header_hash, len(df)))
+
+    cell_hashes = pd.DataFrame({str(i): column_value_hashes(df[c].reset_index(drop=True)) for i, c in enumerate(columns)})
+    row_hashes = pd.util.hash_pandas_object(cell_hashes, index=False).to_numpy()
+    # summing (mod 2^64) makes the combination independent of row order while keeping duplicate rows counted
+    rows_hash = int(row_hashes.sum(dtype=np.uint64))
+    return hash((header_hash, len(df), rows_hash))
+
+
 def table_hash(table):
     """hash a table, mostly for the purpose of comparison"""
-    if len(table) == 0:
-        return hash(table)
-    schema = sorted(list(table[0].keys()))
-    frozen_table = tuple(sorted([tuple([hash(value_handling_func(r[key])) for key in schema]) for r in table]))
-    return hash(frozen_table)
+    return table_fingerprint(table)
+
+
+JSON_START_PATTERN = re.compile(r"[\[{`]")
+JSON_TOKEN_PATTERN = re.compile(r'[\[\]{}"`]')
+JSON_STRING_PATTERN = re.compile(r'["\\`]')
+CLOSING_BRACKETS = {'}': '{', ']': '['}
+
+
+class ResponseScanner(object):
+    """Single-pass scanner of model responses that can be fed the response in pieces (e.g. streamed tokens).
+    It collects the JSON objects / arrays and the fenced (```) code blocks of the text as soon as they are complete.
+    Brackets inside JSON strings are ignored, and an unfinished JSON candidate is abandoned at a code fence,
+    so unbalanced brackets in code cannot swallow the rest of the response."""
+
+    def __init__(self):
+        self.text = ""
+        self.offset = 0 # position of self.text in the whole response, scanned text is dropped as it is consumed
+        self.pos = 0
+
+        self.json_start = None
+        self.json_stack = []
+        self.in_string = False
+        self.block_start = None
+        self.block_language = None
+
+        self.json_objects = []
+        self.code_blocks = [] # raw block contents, starting with the fence's info string (e.g. "python\n...")
+
+    def feed(self, chunk):
+        """scan a piece of the response, returns the json objects and code blocks it completed"""
+        num_objects, num_blocks = len(self.json_objects), len(self.code_blocks)
+        self.text += chunk
+        self._scan(final=False)
+        return self.json_objects[num_objects:], self.code_blocks[num_blocks:]
+
+    def finish(self):
+        """scan what was held back waiting for more input (e.g. a fence at the very end of the response)"""
+        num_objects, num_blocks = len(self.json_objects), len(self.code_blocks)
+        self._scan(final=True)
+        return self.json_objects[num_objects:], self.code_blocks[num_blocks:]
+
+    def code(self, language):
+        """contents of the code blocks fenced with ```language"""
+        return [block[len(language):] for block in self.code_blocks if block.startswith(language)]
+
+    def _abandon_json(self):
+        self.json_start = None
+        self.json_stack = []
+        self.in_string = False
+
+    def _fence(self, pos, final):
+        """handle the ``` at pos, returns the position to continue from or None to wait for more input"""
+        line_end = self.text.find("\n", pos + 3)
+        if line_end == -1 and not final:
+            return None
+
+        info = self.text[pos + 3: line_end if line_end != -1 else len(self.text)].strip()
+        language = info.split()[0] if info != "" else ""
+        self._abandon_json()
+        if self.block_start is not None and (language == "" or self.block_language not in ("", language)):
+            # any fence closes an open block, including one followed by text (e.g. "```trailing"),
+            # unless it starts another block of the same language (or of any language after a plain ```)
+            self.code_blocks.append(self.text[self.block_start - self.offset: pos])
+            self.block_start = None
+        else:
+            # an opening fence, or one that restarts an unterminated block
+            self.block_start = self.offset + pos + 3
+            self.block_language = language
+        return pos + 3
+
+    def _scan(self, final):
+        text = self.text
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = JSON_STRING_PATTERN.search(text, pos)
+            elif self.json_start is not None:
+                match = JSON_TOKEN_PATTERN.search(text, pos)
+            else:
+                match = JSON_START_PATTERN.search(text, pos)
+            if match is None:
+                pos = len(text)
+                break
+
+            pos = match.start()
+            char = text[pos]
+            if char == '`':
+                if len(text) - pos < 3 and not final:
+                    break
+                if text.startswith("```", pos):
+                    next_pos = self._fence(pos, final)
+                    if next_pos is None:
+                        break
+                    pos = next_pos
+                else:
+                    pos += 1
+            elif self.in_string:
+                if char == '\\':
+                    if pos + 1 >= len(text) and not final:
+                        break
+                    pos += 2
+                else:
+                    self.in_string = False
+                    pos += 1
+            elif char == '"':
+                self.in_string = True
+                pos += 1
+            elif char in '{[':
+                if self.json_start is None:
+                    self.json_start = self.offset + pos
+                self.json_stack.append(char)
+                pos += 1
+            else:
+                if self.json_stack[-1] != CLOSING_BRACKETS[char]:
+                    self._abandon_json()
+                else:
+                    self.json_stack.pop()
+                    if len(self.json_stack) == 0:
+                        try:
+                            self.json_objects.append(json.loads(text[self.json_start - self.offset: pos + 1]))
+                        except ValueError:
+                            pass
+                        self._abandon_json()
+                pos += 1
+
+        # drop the text that no open JSON candidate or code block refers to any more
+        keep = min([self.offset + pos] + [start for start in (self.json_start, self.block_start) if start is not None])
+        self.text = text[keep - self.offset:]
+        self.pos = self.offset + pos - keep
+        self.offset = keep
+
+
+def scan_response(text):
+    """scan a complete response"""
+    scanner = ResponseScanner()
+    scanner.feed(text)
+    scanner.finish()
+    return scanner
+
+
+class ResponseStreamHandler(object):
+    """on_token callback for streamed completions: forwards the tokens of every choice to emit(event, **payload)
+    and reports its first JSON object ('refined_goal') and its code blocks ('code') as soon as they are complete"""
+
+    def __init__(self, emit, language="python"):
+        self.emit = emit
+        self.language = language
+        self.scanners = {}
+
+    def __call__(self, index, text):
+        self.emit("tokens", candidate=index, text=text)
+        if index not in self.scanners:
+            self.scanners[index] = ResponseScanner()
+        self._report(index, *self.scanners[index].feed(text), self.scanners[index])
+
+    def finish_choice(self, index):
+        """report what is left of a choice once it is complete (later calls for the same choice do nothing)"""
+        scanner = self.scanners.pop(index, None)
+        if scanner is None:
+            return
+        # responses are scanned with a trailing newline, which closes a fence at the very end
+        num_objects, num_blocks = len(scanner.json_objects), len(scanner.code_blocks)
+        scanner.feed("\n")
+        scanner.finish()
+        self._report(index, scanner.json_objects[num_objects:], scanner.code_blocks[num_blocks:], scanner)
+
+    def finish(self):
+        for index in list(self.scanners):
+            self.finish_choice(index)
+
+    def _report(self, index, json_objects, code_blocks, scanner):
+        if len(json_objects) > 0 and len(scanner.json_objects) == len(json_objects):
+            self.emit("refined_goal", candidate=index, refined_goal=json_objects[0])
+        for block in code_blocks:
+            if block.startswith(self.language):
+                self.emit("code", candidate=index, code=block[len(self.language):])
 
 
 def extract_code_from_gpt_response(code_raw, language):
-    """search for matches and then look for pairs of ```...``` to extract code"""
+    """extract the code blocks fenced with ```language"""
+    return scan_response(code_raw).code(language)
 
-    prefix_pos = [m.span()[0] for m in re.compile(f"```{language}").finditer(code_raw)]
-    all_spans = [m.span() for m in re.compile("```").finditer(code_raw)]
 
-    matches = []
-    for i in range(len(all_spans) - 1):
-        if all_spans[i][0] in prefix_pos and all_spans[i+1][0] not in prefix_pos:
-            matches.append([all_spans[i][0], all_spans[i+1][1]])    
-        
-    results = []
-    if len(matches) > 0:
-        match = matches[0]
-
-        for match in matches:
-            code = code_raw[match[0]: match[1]]
-            code = code[len(f"```{language}"): len(code) - len("```")]
-            results.append(code)
-        
-    return results
-
-
-def find_matching_bracket(text, start_index, bracket_type='curly'):  
-    """Find the index of the matching closing bracket for JSON objects or arrays."""  
-    if bracket_type == 'curly':  
-        open_bracket, close_bracket = '{', '}'  
-    elif bracket_type == 'square':  
-        open_bracket, close_bracket = '[', ']'  
-    else:  
-        raise ValueError("Invalid bracket_type. Use 'curly' or 'square'.")  
-  
-    stack = []  
-    for index in range(start_index, len(text)):  
-        char = text[index]  
-        if char == open_bracket:  
-            stack.append(char)  
-        elif char == close_bracket:  
-            if not stack:  
-                return -1  
-            stack.pop()  
-            if not stack:  
-                return index  
-    return -1  
-  
 def extract_json_objects(text):  
     """Extracts JSON objects and arrays from a text string.  
     Returns a list of parsed JSON objects and arrays.  
     """  
-    json_objects = []  
-    start_index = 0  
-    while True:  
-        # Search for the start of a JSON object or array  
-        object_start = text.find('{', start_index)  
-        array_start = text.find('[', start_index)  
-          
-        # Find the earliest JSON structure start  
-        if object_start == -1 and array_start == -1:  
-            break  
-        elif object_start == -1:  
-            start_index = array_start  
-            bracket_type = 'square'  
-        elif array_start == -1:  
-            start_index = object_start  
-            bracket_type = 'curly'  
-        else:  
-            start_index = min(object_start, array_start)  
-            bracket_type = 'square' if start_index == array_start else 'curly'  
-          
-        # Find the matching closing bracket  
-        end_index = find_matching_bracket(text, start_index, bracket_type)  
-        if end_index == -1:  
-            break  
-          
-        json_str = text[start_index:end_index + 1]  
-        try:  
-            json_obj = json.loads(json_str)  
-            json_objects.append(json_obj)  
-        except ValueError:  
-            pass  
-  
-        start_index = end_index + 1  
-  
-    return json_objects  
+    return scan_response(text).json_objects
 
 
 def insert_candidates(code, table, dialog, candidate_groups):
     """ Try to insert a candidate into existing candidate groups
     Args:
         code: code candidate
-        table: json records table
+        table: json records table or dataframe
         candidate_groups: current candidate group
     Returns:
         a boolean flag incidate whether new_group_created
     """
-    table_headers = sorted(table[0].keys())
-    t_hash = table_hash([{c: r[c] for c in table_headers} for r in table])
+    t_hash = table_fingerprint(table)
     if t_hash in candidate_groups:
         candidate_groups[t_hash].append({"code": code, "content": table, "dialog": dialog})
         new_group_created = False
@@ -173,49 +318,104 @@ def insert_candidates(code, table, dialog, candidate_groups):
     return new_group_created
 
 def dedup_data_transform_candidates(candidates):
-    """each candidate is a tuple of {status: ..., code: ..., data: ..., dialog: ...},
-    this function extracts candidates that are 'ok', and removes uncessary duplicates"""
+    """each candidate is a dict of {status: ..., code: ..., content: ..., dialog: ...} whose content is the output table
+    (json records or a dataframe), this function extracts candidates that are 'ok', and removes uncessary duplicates
+    (candidates producing the same table), keeping the first candidate of each group"""
     candidate_groups = {}
     for candidate in candidates:
-        insert_candidates(candidate["code"], candidate['data'], candidate['dialog'], candidate_groups)
-    return [items[0] for _, items in candidate_groups.items()]
+        if candidate['status'] != 'ok':
+            continue
+        t_hash = table_fingerprint(candidate['content'])
+        if t_hash not in candidate_groups:
+            candidate_groups[t_hash] = candidate
+    return list(candidate_groups.values())
 
 
-def get_field_summary(field_name, df, field_sample_size):
-    try:
-        values = sorted([x for x in list(set(df[field_name].values)) if x != None])
-    except:
-        values = [x for x in list(set(df[field_name].values)) if x != None]
-
-    val_sample = ""
+def results_as_records(candidates):
+    """candidates whose output table (a dataframe from the sandbox) is converted to json records, serialized the way 
+    the app serializes results, for callers of the agents that expect the rows themselves"""
+    for candidate in candidates:
+        if candidate['status'] == 'ok' and isinstance(candidate.get('content'), pd.DataFrame):
+            candidate['content'] = json.loads(candidate['content'].to_json(orient="records", default_handler=str))
+    return candidates
 
-    sample_size = field_sample_size
 
-    if len(values) <= sample_size:
-        val_sample = values
+def get_field_summary(field_name, df, field_sample_size):
+    return format_field_summary(profile_field(df[field_name], field_sample_size))
+
+def table_content_hash(df):
+    """exact, row order sensitive hash of a dataframe's values (cheaper than table_fingerprint, no value normalization),
+    None when a column holds values that cannot be hashed exactly (anything but the values json records are made of)"""
+    digest = hashlib.sha1()
+    for name in df.columns:
+        column = df[name]
+        if column.dtype == object and pd.api.types.infer_dtype(column, skipna=False) != "string":
+            # mixed and unhashable cells (lists, dicts) are hashed by their repr, which also tells apart 1 and "1"
+            if not all(isinstance(value, (str, int, float, bool, list, dict, type(None))) for value in column):
+                return None
+            column = column.map(repr)
+        digest.update(pd.util.hash_pandas_object(column, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_table_profile(table, field_sample_size=7):
+    """profile (dtypes, value summaries and typescript types of the fields) of a table {"name": ..., "rows": [...]},
+    computed once and shared through table_profile_cache. Rows resolved from the table registry (RegisteredRows) are
+    looked up by their table id without touching the rows, other tables by a hash of their content, columns and dtypes
+    (a "table_id" sent by the client along with the rows is not trusted).
+    The returned profile is shared, callers must not modify it."""
+    df = None
+    table_id = getattr(table['rows'], 'table_id', None)
+    if table_id is not None:
+        key = ("table_id", table_id, field_sample_size)
     else:
-        val_sample = values[:int(sample_size / 2)] + ["..."] + values[-(sample_size - int(sample_size / 2)):]
-
-    val_str = ', '.join([str(s) if ',' not in str(s) else f'"{str(s)}"' for s in val_sample])
-
-    return f"{field_name} -- type: {df[field_name].dtype}, values: {val_str}"
-
-def generate_data_summary(input_tables, include_data_samples=True, field_sample_size=7):
+        df = pd.DataFrame(table['rows'])
+        content_hash = table_content_hash(df)
+        key = ("content", content_hash, tuple(str(c) for c in df.columns), tuple(str(t) for t in df.dtypes), field_sample_size) \
+            if content_hash is not None else None
+
+    profile = table_profile_cache.get(key) if key is not None else None
+    if profile is None:
+        if df is None:
+            df = pd.DataFrame(table['rows'])
+        profile = profile_table(df, field_sample_size)
+        for field in profile['fields']:
+            field['ts_type'] = infer_ts_datatype(df, field['name'])
+        if key is not None:
+            table_profile_cache.put(key, profile)
+    return profile
+
+
+def get_ts_datatypes(table):
+    """typescript types of the fields of a table, from its cached profile"""
+    return {field['name']: field['ts_type'] for field in get_table_profile(table)['fields']}
+
+
+def generate_data_summary(input_tables, include_data_samples=True, field_sample_size=7, num_sample_rows=5, omitted_fields={}, profiles=None):
+    """omitted_fields maps table names to fields whose summaries (and sample values) are left out, only their names are listed.
+    profiles are the tables' profiles (get_table_profile) when the caller already has them, their sample values are 
+    then cut down to field_sample_size instead of profiling the tables again"""
     
     input_table_names = [f'{string_to_py_varname(t["name"])}' for t in input_tables]
 
-    data_samples = [t['rows'][:5] for t in input_tables]
+    data_samples = [pd.DataFrame(t['rows'][:num_sample_rows]).drop(columns=omitted_fields.get(t['name'], []), errors='ignore') for t in input_tables]
 
     field_summaries = []
-    for input_data in input_tables:
-        df = pd.DataFrame(input_data['rows'])
-        s = '\n\t'.join([get_field_summary(fname, df, field_sample_size)  for fname in list(df.columns.values)])
+    for i, input_data in enumerate(input_tables):
+        if profiles is not None:
+            fields = [shrink_field_profile(field, field_sample_size) for field in profiles[i]['fields']]
+        else:
+            fields = get_table_profile(input_data, field_sample_size)['fields']
+        omitted = omitted_fields.get(input_data['name'], [])
+        s = '\n\t'.join([format_field_summary(field) for field in fields if field['name'] not in omitted])
+        if len(omitted) > 0:
+            s += f"\n\t(other fields, summaries omitted: {', '.join(str(name) for name in omitted)})"
         field_summaries.append(s)
 
     table_field_summaries = [f'table_{i} ({input_table_names[i]}) fields:\n\t{s}' for i, s in enumerate(field_summaries)]
     
     if include_data_samples:
-        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{pd.DataFrame(data_sample).to_csv(sep="|")}......\n```' for i, data_sample in enumerate(data_samples)]
+        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{data_sample.to_csv(sep="|")}......\n```' for i, data_sample in enumerate(data_samples)]
     else:
         table_sample_strings = ['' for i, data_sample in enumerate(data_samples)]
 
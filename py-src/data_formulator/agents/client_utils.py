@@ -1,7 +1,161 @@
+import concurrent.futures
+import copy
+import hashlib
 import os
+import threading
+import time
+
+import httpx
 import litellm
 import openai
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
+
+from data_formulator.agents.completion_cache import get_completion_cache
+from data_formulator.cache_utils import LRUCache
+from data_formulator.agents.rate_limiter import get_rate_limiter, call_with_retries
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# keep-alive connection pool shared by all requests to one provider configuration
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", 32))
+LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", 120))
+
+# endpoints that generate n choices in one request, for the others n completions are requested concurrently
+NATIVE_N_ENDPOINTS = ["openai", "azure"]
+
+
+def new_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=LLM_HTTP_POOL_SIZE, max_keepalive_connections=LLM_HTTP_POOL_SIZE),
+        timeout=LLM_HTTP_TIMEOUT)
+
+# litellm builds its openai/azure clients on top of this session, so they share one connection pool as well
+if litellm.client_session is None:
+    litellm.client_session = new_http_client()
+
+
+# openai clients (each with its own keep-alive pool) kept open, the least recently used ones are closed
+OPENAI_CLIENTS_MAX = int(os.getenv("OPENAI_CLIENTS_MAX", 32))
+
+
+def close_evicted_openai_client(key, client):
+    """close the connection pool of an evicted client once requests still running on it had time to finish"""
+    timer = threading.Timer(LLM_HTTP_TIMEOUT, client.close)
+    timer.daemon = True
+    timer.start()
+
+
+_openai_clients = LRUCache(max_items=OPENAI_CLIENTS_MAX, on_evict=close_evicted_openai_client)
+_openai_clients_lock = threading.Lock()
+
+def get_openai_client(api_key, api_base=None):
+    """process-wide openai.OpenAI clients, one per (api_base, api key hash), each with its own keep-alive pool.
+    The clients are thread-safe and shared by all requests, at most OPENAI_CLIENTS_MAX of them are kept."""
+    key = (api_base, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+    with _openai_clients_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=api_key, 
+                base_url=api_base,
+                timeout=LLM_HTTP_TIMEOUT,
+                http_client=new_http_client()
+            )
+            _openai_clients.put(key, client)
+        return client
+
+
+AZURE_COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+class AzureTokenProvider(object):
+    """bearer token provider for one resource scope, shared by every Client in the process.
+    The token is cached and refreshed in a background thread refresh_margin seconds before it expires, 
+    so requests normally never wait for token acquisition."""
+
+    def __init__(self, credential, scope, refresh_margin=300):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.lock = threading.Lock()
+        # the one pending background refresh, replaced (cancelled) whenever a new one is scheduled
+        self.refresh_timer = None
+
+        self.num_acquisitions = 0
+        self.last_acquisition_seconds = None
+        self.total_acquisition_seconds = 0.0
+
+    def _acquire(self):
+        start = time.time()
+        self.token = self.credential.get_token(self.scope)
+        elapsed = time.time() - start
+
+        self.num_acquisitions += 1
+        self.last_acquisition_seconds = elapsed
+        self.total_acquisition_seconds += elapsed
+        logger.info(f"acquired azure token for {self.scope} in {elapsed:.3f}s")
+
+        self._schedule_refresh(self.token.expires_on - time.time() - self.refresh_margin)
+
+    def _schedule_refresh(self, delay):
+        """(re)schedule the background refresh, called with self.lock held"""
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+        self.refresh_timer = threading.Timer(max(delay, 0), self._refresh)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def _refresh(self):
+        try:
+            with self.lock:
+                self._acquire()
+        except Exception as e:
+            logger.warning(f"background refresh of the azure token for {self.scope} failed: {e}")
+            # retry while the current token is still valid, otherwise the next request acquires it
+            with self.lock:
+                if self.token is not None and self.token.expires_on - time.time() > 60:
+                    self._schedule_refresh(30)
+
+    def __call__(self):
+        with self.lock:
+            if self.token is None or self.token.expires_on - time.time() < 60:
+                self._acquire()
+            return self.token.token
+
+    def stats(self):
+        return {
+            "scope": self.scope,
+            "num_acquisitions": self.num_acquisitions,
+            "last_acquisition_seconds": self.last_acquisition_seconds,
+            "total_acquisition_seconds": self.total_acquisition_seconds,
+            "expires_on": self.token.expires_on if self.token is not None else None,
+        }
+
+
+_azure_credential = None
+_azure_token_providers = {}
+_azure_lock = threading.Lock()
+
+def get_azure_token_provider(scope=AZURE_COGNITIVE_SERVICES_SCOPE):
+    """the process-wide token provider for scope, DefaultAzureCredential discovery runs only once per process"""
+    global _azure_credential
+    with _azure_lock:
+        if _azure_credential is None:
+            _azure_credential = DefaultAzureCredential()
+        if scope not in _azure_token_providers:
+            _azure_token_providers[scope] = AzureTokenProvider(_azure_credential, scope)
+        return _azure_token_providers[scope]
+
+
+def azure_token_provider_stats():
+    """stats of the token providers created so far in this process"""
+    with _azure_lock:
+        providers = list(_azure_token_providers.values())
+    return [provider.stats() for provider in providers]
+
 
 class Client(object):
     """
@@ -42,10 +196,7 @@ class Client(object):
             self.params["api_base"] = api_base
             self.params["api_version"] = api_version if api_version else "2024-02-15-preview"
             if api_key is None or api_key == "":
-                token_provider = get_bearer_token_provider(
-                    DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
-                )
-                self.params["azure_ad_token_provider"] = token_provider
+                self.params["azure_ad_token_provider"] = get_azure_token_provider()
             self.params["custom_llm_provider"] = "azure"
         elif self.endpoint == "ollama":
             self.params["api_base"] = api_base if api_base else "http://localhost:11434"
@@ -55,19 +206,202 @@ class Client(object):
             else:
                 self.model = f"ollama/{model}"
 
-    def get_completion(self, messages):
+    # completions of this client skip the completion cache, set on per-request views (with_bypass_cache)
+    bypass_cache = False
+
+    def with_bypass_cache(self, bypass_cache=True):
+        """this client when bypass_cache is false, otherwise a per-request view of it (sharing its configuration and
+        connections) whose completions are always fresh, so the shared client is left as it is"""
+        if not bypass_cache:
+            return self
+        client = copy.copy(self)
+        client.bypass_cache = True
+        return client
+
+    def get_completion(self, messages, bypass_cache=None, on_token=None, n=1):
         """
-        Returns a LiteLLM client configured for the specified endpoint and model.
+        Returns the completion for messages, served from the completion cache when it is enabled 
+        (LLM_CACHE_ENABLED) and the same request was answered before. bypass_cache (default: the client's
+        bypass_cache) forces a fresh completion (which then replaces the cached one).
+        When on_token is given, the completion is streamed and on_token(choice_index, text) is called 
+        with each piece of generated text as it arrives (a cached completion arrives as a single piece).
+        n > 1 requests n choices (candidates) for the same messages.
+        """
+        bypass_cache = self.bypass_cache if bypass_cache is None else bypass_cache
+        cache = get_completion_cache()
+        if cache is None:
+            return self.complete(messages, on_token, n)
+
+        key = self.completion_cache_key(cache, messages, n)
+        if not bypass_cache:
+            response = self.get_cached_completion(cache, key, on_token)
+            if response is not None:
+                return response
+
+        response = self.complete(messages, on_token, n)
+        cache.put(key, response)
+        return response
+
+    def iter_completions(self, messages, bypass_cache=None, on_token=None, n=1):
+        """
+        Like get_completion, but yields the choices one at a time as soon as each of them is complete, so that
+        callers can start working on the first choices while the others are still being generated: streamed choices 
+        when their finish_reason arrives, and for endpoints without native n each choice when its own request returns.
+        The response is cached once every choice has arrived.
+        """
+        bypass_cache = self.bypass_cache if bypass_cache is None else bypass_cache
+        if on_token is None and (n == 1 or self.endpoint in NATIVE_N_ENDPOINTS):
+            # one request that returns every choice at once
+            yield from self.get_completion(messages, bypass_cache, None, n).choices
+            return
+
+        cache = get_completion_cache()
+        if cache is not None:
+            key = self.completion_cache_key(cache, messages, n)
+            if not bypass_cache:
+                response = self.get_cached_completion(cache, key, on_token)
+                if response is not None:
+                    yield from response.choices
+                    return
+
+        if n > 1 and self.endpoint not in NATIVE_N_ENDPOINTS:
+            choices = self.iter_concurrent_choices(messages, on_token, n)
+        else:
+            choices = self.iter_streamed_choices(messages, on_token, n)
+
+        completed = []
+        for choice in choices:
+            completed.append(choice)
+            yield choice
+
+        if cache is not None:
+            cache.put(key, self.merge_choices(completed))
+
+    def completion_cache_key(self, cache, messages, n):
+        return cache.make_key(self.endpoint, self.model, messages, self.params if n == 1 else {**self.params, "n": n})
+
+    def get_cached_completion(self, cache, key, on_token):
+        response = cache.get(key)
+        if response is not None and on_token is not None:
+            for choice in response.choices:
+                on_token(choice.index, choice.message.content)
+        return response
+
+    def merge_choices(self, choices):
+        """one response holding choices (in index order)"""
+        return litellm.ModelResponse(model=self.model, choices=[
+            {"index": choice.index, "finish_reason": choice.finish_reason,
+             "message": {"role": "assistant", "content": choice.message.content}}
+            for choice in sorted(choices, key=lambda choice: choice.index)])
+
+    def complete(self, messages, on_token=None, n=1):
+        if n > 1 and self.endpoint not in NATIVE_N_ENDPOINTS:
+            return self.complete_concurrently(messages, on_token, n)
+        if on_token is None:
+            return self.send_request(messages, n=n)
+        return self.stream_completion(messages, on_token, n)
+
+    def complete_concurrently(self, messages, on_token, n):
+        """
+        Requests n single-choice completions in parallel and merges them into one response with n choices.
+        Failed requests are dropped, the first error is raised only if all of them fail.
+        """
+        choices = list(self.iter_concurrent_choices(messages, on_token, n))
+        # renumbered, failed requests leave gaps
+        for index, choice in enumerate(sorted(choices, key=lambda choice: choice.index)):
+            choice.index = index
+        return self.merge_choices(choices)
+
+    def iter_concurrent_choices(self, messages, on_token, n):
+        """
+        Requests n single-choice completions in parallel and yields the choice of each request as soon as it returns,
+        its index is the index of the request (the one on_token reports). Failed requests are dropped, the first 
+        error is raised only if all of them fail.
+        """
+        def request(index):
+            if on_token is None:
+                return self.complete(messages)
+            return self.complete(messages, lambda _, text: on_token(index, text))
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+        try:
+            futures = {executor.submit(request, index): index for index in range(n)}
+            errors = []
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    choice = future.result().choices[0]
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                choice.index = futures[future]
+                yield choice
+        finally:
+            # the caller may stop early, requests that are still running are not waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if len(errors) == n:
+            raise errors[0]
+        if len(errors) > 0:
+            logger.warning(f"{len(errors)} of {n} completion requests failed: {errors[0]}")
+
+    def stream_completion(self, messages, on_token, n=1):
+        """
+        Requests a streamed completion, reports text pieces to on_token as they arrive and returns 
+        the assembled response (same shape as a non-streamed one). If on_token raises, the stream 
+        is closed and the exception propagates.
+        """
+        return self.merge_choices(list(self.iter_streamed_choices(messages, on_token, n)))
+
+    def iter_streamed_choices(self, messages, on_token, n=1):
+        """
+        Requests a streamed completion, reports text pieces to on_token as they arrive and yields 
+        each choice (same shape as a non-streamed one) as soon as its finish_reason arrives.
+        """
+        contents = {}
+        finished = set()
+
+        stream = self.send_request(messages, stream=True, n=n)
+        try:
+            for chunk in stream:
+                for choice in chunk.choices:
+                    text = choice.delta.content if choice.delta is not None else None
+                    if text:
+                        contents.setdefault(choice.index, []).append(text)
+                        on_token(choice.index, text)
+                    if choice.finish_reason and choice.index not in finished:
+                        finished.add(choice.index)
+                        yield self.make_choice(choice.index, "".join(contents.get(choice.index, [])), choice.finish_reason)
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+        # choices the stream ended without a finish_reason for
+        for index in sorted(contents):
+            if index not in finished:
+                yield self.make_choice(index, "".join(contents[index]), "stop")
+
+    def make_choice(self, index, content, finish_reason):
+        return litellm.Choices(index=index, finish_reason=finish_reason, message=litellm.Message(role="assistant", content=content))
+
+    def send_request(self, messages, stream=False, n=1):
+        """
+        request_completion through the rate limiter shared by all clients of this provider and model,
+        throttled requests are retried (see rate_limiter.call_with_retries).
+        """
+        rate_limiter = get_rate_limiter(self.endpoint, self.model, self.params.get("api_base"))
+        # prompt at about 4 characters per token, plus the completion budget of every choice
+        estimated_tokens = sum(len(str(m["content"])) for m in messages) // 4 + n * self.params.get("max_completion_tokens", 0)
+        return call_with_retries(rate_limiter, lambda: self.request_completion(messages, stream, n), estimated_tokens)
+
+    def request_completion(self, messages, stream=False, n=1):
+        """
+        Sends messages to the configured endpoint and model.
         Supports OpenAI, Azure, Ollama, and other providers via LiteLLM.
         """
         # Configure LiteLLM 
 
         if self.endpoint == "openai":
-            client = openai.OpenAI(
-                api_key=self.params["api_key"], 
-                base_url=self.params["api_base"] if "api_base" in self.params else None,
-                timeout=120
-            )
+            client = get_openai_client(self.params["api_key"], self.params["api_base"] if "api_base" in self.params else None)
 
             completion_params = {
                 "model": self.model,
@@ -77,6 +411,11 @@ class Client(object):
             if not (self.model == "o3-mini" or self.model == "o1"):
                 completion_params["temperature"] = self.params["temperature"]
                 completion_params["max_tokens"] = self.params["max_completion_tokens"]
+
+            if stream:
+                completion_params["stream"] = True
+            if n > 1:
+                completion_params["n"] = n
                 
             return client.chat.completions.create(**completion_params)
         elif self.endpoint == "ollama":
@@ -94,11 +433,12 @@ class Client(object):
             # 如果有系统消息，将其与第一个用户消息合并
             if system_content and len(user_messages) > 0:
                 combined_messages = user_messages.copy()
-                combined_messages[0]["content"] = f"{system_content}\n\n{combined_messages[0]['content']}"
+                combined_messages[0] = {**combined_messages[0], "content": f"{system_content}\n\n{combined_messages[0]['content']}"}
                 return litellm.completion(
                     model=self.model,
                     messages=combined_messages,
                     drop_params=True,
+                    stream=stream,
                     **self.params
                 )
             
@@ -106,6 +446,7 @@ class Client(object):
                 model=self.model,
                 messages=user_messages if user_messages else messages,
                 drop_params=True,
+                stream=stream,
                 **self.params
             )
         else:
@@ -113,5 +454,7 @@ class Client(object):
                 model=self.model,
                 messages=messages,
                 drop_params=True,
+                stream=stream,
+                n=n,
                 **self.params
             )
\ No newline at end of file
@@ -0,0 +1,165 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import litellm
+
+from data_formulator.cache_utils import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the completion cache is opt-in, responses are reused for identical (model, endpoint, messages, sampling params)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 24 * 3600))
+LLM_CACHE_MAX_ITEMS = int(os.getenv("LLM_CACHE_MAX_ITEMS", 512))
+# on-disk tier, set LLM_CACHE_DIR to an empty string to keep the cache in memory only
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".data_formulator", "llm_cache"))
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024))
+
+# client params that change the completion, credentials and callables are left out of the key
+CACHE_KEY_PARAMS = ["temperature", "max_completion_tokens", "max_tokens", "n", "api_base", "api_version", "custom_llm_provider"]
+
+
+class CompletionCache(object):
+    """two-tier cache of completion responses: an in-memory LRU in front of a directory of json files.
+    Both tiers expire entries after ttl seconds, the disk tier drops its oldest files beyond disk_max_bytes."""
+
+    def __init__(self, ttl=LLM_CACHE_TTL, max_items=LLM_CACHE_MAX_ITEMS, cache_dir=LLM_CACHE_DIR, disk_max_bytes=LLM_CACHE_DISK_MAX_BYTES):
+        self.ttl = ttl
+        self.memory = LRUCache(max_items=max_items, ttl=ttl)
+        self.cache_dir = cache_dir if cache_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_lock = threading.Lock()
+
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    @staticmethod
+    def make_key(endpoint, model, messages, params):
+        normalized = {
+            "endpoint": endpoint,
+            "model": model,
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "params": {name: params[name] for name in CACHE_KEY_PARAMS if name in params},
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _disk_entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                    entries.append((name, stat.st_size, stat.st_mtime))
+                except OSError:
+                    pass
+        return entries
+
+    def get(self, key):
+        response = self.memory.get(key)
+        if response is not None:
+            return response
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                if time.time() - os.path.getmtime(path) <= self.ttl:
+                    with open(path, "r", encoding="utf-8") as f:
+                        response = litellm.ModelResponse(**json.load(f))
+                    self.memory.put(key, response)
+                    self.disk_hits += 1
+                    return response
+            except (OSError, ValueError, TypeError):
+                pass
+
+        self.misses += 1
+        return None
+
+    def put(self, key, response):
+        self.memory.put(key, response)
+
+        if self.cache_dir is None:
+            return
+        try:
+            data = json.dumps(response.model_dump(), ensure_ascii=False).encode("utf-8")
+        except Exception as e:
+            logger.warning(f"unable to serialize completion for the disk cache: {e}")
+            return
+
+        with self.disk_lock:
+            path = self._path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                try:
+                    # the file of the same key, if any, is replaced
+                    replaced_bytes = os.path.getsize(path)
+                except OSError:
+                    replaced_bytes = 0
+                os.replace(tmp_path, path)
+                self.disk_bytes += len(data) - replaced_bytes
+            except OSError as e:
+                logger.warning(f"unable to write completion cache entry: {e}")
+                return
+
+            if self.disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """remove the oldest files until the disk tier is back under 90% of its budget"""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        for name, size, _ in entries:
+            if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                self.disk_bytes -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        memory_stats = self.memory.stats()
+        return {
+            "memory_hits": memory_stats["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": memory_stats["items"],
+            "memory_evictions": memory_stats["evictions"],
+            "disk_bytes": self.disk_bytes if self.cache_dir is not None else 0,
+        }
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+    """the process-wide completion cache, or None when it is not enabled (LLM_CACHE_ENABLED)"""
+    global _completion_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = CompletionCache()
+        return _completion_cache
+
+
+def completion_cache_stats():
+    """stats of the process-wide completion cache, None when it is not enabled"""
+    cache = get_completion_cache()
+    return cache.stats() if cache is not None else None
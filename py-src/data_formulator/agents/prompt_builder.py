@@ -0,0 +1,103 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+
+import litellm
+
+from data_formulator.agents.agent_utils import get_table_profile
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# input token budget of agent prompts, 0 disables the budget
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 12000))
+
+# (values per field, sample rows) of the data summary, from the default to the most compact
+SUMMARY_SAMPLE_SIZES = [(7, 5), (5, 3), (3, 2), (2, 1)]
+# older conversation turns are first cut to this many characters, then dropped
+CONDENSED_TURN_CHARS = 300
+
+
+def count_tokens(model, messages):
+    """number of prompt tokens of messages for model, approximated as 4 characters per token
+    when litellm has no tokenizer for the model"""
+    try:
+        return litellm.token_counter(model=model, messages=messages)
+    except Exception:
+        return sum(len(m["content"]) for m in messages) // 4
+
+
+class PromptBuilder(object):
+    """Builds agent prompts within a token budget.
+    render(state) turns a prompt state into messages, each shrink step reduces the state a little further
+    (returning False once it cannot) and steps are applied in order until the prompt fits the budget."""
+
+    def __init__(self, model, budget=PROMPT_TOKEN_BUDGET):
+        self.model = model
+        self.budget = budget
+
+    def build(self, name, state, render, shrink_steps=[]):
+        messages = render(state)
+        tokens = initial_tokens = count_tokens(self.model, messages)
+
+        steps = list(shrink_steps)
+        while self.budget > 0 and tokens > self.budget and len(steps) > 0:
+            if not steps[0](state):
+                steps.pop(0)
+                continue
+            messages = render(state)
+            tokens = count_tokens(self.model, messages)
+
+        if tokens > self.budget > 0:
+            logger.warning(f"{name} prompt: {initial_tokens} -> {tokens} tokens, still over the budget of {self.budget}")
+        else:
+            logger.info(f"{name} prompt: {initial_tokens} -> {tokens} tokens (budget {self.budget})")
+        return messages
+
+
+# shrink steps for prompts built from a data summary and previous turns, they work on a state with the keys
+# "sample_level" (index into SUMMARY_SAMPLE_SIZES), "omitted_fields" ({table name: [fields]}) and "turns" (messages)
+
+def trim_value_samples(state):
+    """fewer example values per field and fewer sample rows"""
+    if state["sample_level"] + 1 >= len(SUMMARY_SAMPLE_SIZES):
+        return False
+    state["sample_level"] += 1
+    return True
+
+
+def drop_low_relevance_fields(input_tables, context, profiles=None):
+    """returns a step that omits the summaries of fields not mentioned in context (e.g. the instruction), 
+    starting from the last fields of each table, a quarter of them at a time"""
+    context = context.lower()
+    if profiles is None:
+        profiles = [get_table_profile(table) for table in input_tables]
+    candidates = []
+    for table, profile in zip(input_tables, profiles):
+        names = [field['name'] for field in profile['fields']]
+        candidates.extend([(table['name'], name) for name in reversed(names) if str(name).lower() not in context])
+    batch_size = max(1, len(candidates) // 4)
+
+    def step(state):
+        if len(candidates) == 0:
+            return False
+        for table_name, name in candidates[:batch_size]:
+            state["omitted_fields"].setdefault(table_name, []).append(name)
+        del candidates[:batch_size]
+        return True
+    return step
+
+
+def condense_older_turns(state):
+    """cut the oldest long turn (the latest one is kept as is), once all are short drop the oldest turn"""
+    turns = state["turns"]
+    for i, turn in enumerate(turns[:-1]):
+        if len(turn["content"]) > CONDENSED_TURN_CHARS:
+            turns[i] = {**turn, "content": turn["content"][:CONDENSED_TURN_CHARS] + " ..."}
+            return True
+    if len(turns) > 1:
+        turns.pop(0)
+        return True
+    return False
@@ -0,0 +1,191 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from email.utils import parsedate_to_datetime
+import json
+import os
+import random
+import threading
+import time
+
+import openai
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# requests / tokens per minute allowed per provider and model, as json keyed by "endpoint/model", model or endpoint
+# (most specific first), e.g. {"azure/gpt-4o": {"rpm": 300, "tpm": 50000}, "openai": {"rpm": 500}}
+LLM_RATE_LIMITS = json.loads(os.getenv("LLM_RATE_LIMITS", "{}") or "{}")
+# limits of providers and models not listed in LLM_RATE_LIMITS, 0 means unlimited
+LLM_DEFAULT_RPM = float(os.getenv("LLM_DEFAULT_RPM", 0))
+LLM_DEFAULT_TPM = float(os.getenv("LLM_DEFAULT_TPM", 0))
+# bursts are capped at this many seconds worth of the rate
+LLM_RATE_BURST_SECONDS = float(os.getenv("LLM_RATE_BURST_SECONDS", 10))
+
+# throttled (429) requests are retried, honoring Retry-After, until this many seconds after the first attempt
+LLM_RETRY_DEADLINE = float(os.getenv("LLM_RETRY_DEADLINE", 90))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 6))
+# backoff cap when the provider does not send Retry-After
+LLM_RETRY_MAX_BACKOFF = float(os.getenv("LLM_RETRY_MAX_BACKOFF", 30))
+
+
+class RateLimitDeadlineExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """token bucket refilled at per_minute / 60 per second, holding at most burst_seconds worth of tokens.
+    Callers reserve tokens up front (the bucket may go into debt) and sleep for the returned delay,
+    so concurrent callers are served in the order they reserved."""
+
+    def __init__(self, per_minute, burst_seconds=LLM_RATE_BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount, now):
+        """seconds until amount tokens are available"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter(object):
+    """request (rpm) and token (tpm) buckets of one provider and model, shared by every Client using them.
+    After a throttled request, pause() holds back all callers until the provider's Retry-After has passed."""
+
+    def __init__(self, name, rpm=0, tpm=0):
+        self.name = name
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.total_wait_seconds = 0.0
+
+    def acquire(self, num_tokens, deadline):
+        """wait until a request of about num_tokens tokens may be sent, raises RateLimitDeadlineExceeded
+        instead if that is after deadline"""
+        with self.lock:
+            now = time.time()
+            wait = max(0.0, self.paused_until - now)
+            if self.request_bucket is not None:
+                wait = max(wait, self.request_bucket.delay(1, now))
+            if self.token_bucket is not None:
+                wait = max(wait, self.token_bucket.delay(num_tokens, now))
+            if now + wait > deadline:
+                raise RateLimitDeadlineExceeded(f"rate limit of {self.name}: next request in {wait:.1f}s, after the retry deadline")
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None:
+                self.token_bucket.take(num_tokens)
+            self.num_requests += 1
+            self.total_wait_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        """correct the token bucket once the actual usage of a request is known"""
+        if self.token_bucket is None or not isinstance(used_tokens, (int, float)):
+            return
+        with self.lock:
+            if used_tokens > estimated_tokens:
+                self.token_bucket.take(used_tokens - estimated_tokens)
+            else:
+                self.token_bucket.give_back(estimated_tokens - used_tokens)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.num_throttled += 1
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "requests": self.num_requests,
+            "throttled": self.num_throttled,
+            "total_wait_seconds": self.total_wait_seconds,
+        }
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(endpoint, model, api_base=None):
+    """the process-wide rate limiter of a provider configuration, limits are looked up in LLM_RATE_LIMITS"""
+    key = (endpoint, model, api_base)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            limits = {"rpm": LLM_DEFAULT_RPM, "tpm": LLM_DEFAULT_TPM}
+            for name in [f"{endpoint}/{model}", model, endpoint]:
+                if name in LLM_RATE_LIMITS:
+                    limits = {**limits, **LLM_RATE_LIMITS[name]}
+                    break
+            name = model if model.startswith(f"{endpoint}/") else f"{endpoint}/{model}"
+            _rate_limiters[key] = RateLimiter(name, limits["rpm"], limits["tpm"])
+        return _rate_limiters[key]
+
+
+def is_throttled(err):
+    return isinstance(err, openai.RateLimitError) or getattr(err, "status_code", None) == 429
+
+
+def retry_after_seconds(err):
+    """the delay the provider asked for (retry-after-ms / retry-after headers), None if it did not say"""
+    headers = getattr(err, "headers", None)
+    if not headers:
+        response = getattr(err, "response", None)
+        headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def call_with_retries(rate_limiter, request, estimated_tokens, deadline_seconds=LLM_RETRY_DEADLINE):
+    """send request() through rate_limiter, throttled requests are retried after the provider's Retry-After
+    (exponential backoff with jitter when it is missing) until LLM_MAX_RETRIES or the deadline is reached"""
+    deadline = time.time() + deadline_seconds
+    attempt = 0
+    while True:
+        rate_limiter.acquire(estimated_tokens, deadline)
+        try:
+            response = request()
+        except Exception as err:
+            if not is_throttled(err) or attempt >= LLM_MAX_RETRIES:
+                raise
+            wait = retry_after_seconds(err)
+            if wait is None:
+                wait = min(LLM_RETRY_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+            if time.time() + wait > deadline:
+                raise
+            logger.warning(f"{rate_limiter.name} throttled, retrying in {wait:.1f}s (attempt {attempt + 1})")
+            rate_limiter.pause(wait)
+            attempt += 1
+            continue
+
+        usage = getattr(response, "usage", None)
+        rate_limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+        return response
@@ -0,0 +1,127 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+# tables with more rows are profiled on a random sample of this many rows (numeric columns are still profiled in full)
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", 100000))
+
+
+def extreme_values(values, sample_size, head_size=None):
+    """the head_size (default sample_size / 2) smallest and remaining largest of the (distinct, sortable) values, 
+    or all of them sorted"""
+    head_size = int(sample_size / 2) if head_size is None else head_size
+    if len(values) <= sample_size:
+        return sorted(values) if isinstance(values, list) else list(np.sort(values))
+    if isinstance(values, list):
+        return heapq.nsmallest(head_size, values) + ["..."] + sorted(heapq.nlargest(sample_size - head_size, values))
+    values = pd.Series(values)
+    return list(values.nsmallest(head_size).to_numpy()) + ["..."] + list(np.sort(values.nlargest(sample_size - head_size).to_numpy()))
+
+
+def is_typed_numeric(column):
+    return isinstance(column.dtype, np.dtype) and column.dtype.kind in "biuf"
+
+
+def is_typed_string(column):
+    """object column holding only strings and None (NaN would make the values unsortable)"""
+    if column.dtype != object:
+        return False
+    missing = column.isna()
+    if missing.any() and not column[missing].map(lambda x: x is None).all():
+        return False
+    present = column[~missing]
+    return len(present) == 0 or pd.api.types.infer_dtype(present, skipna=False) == "string"
+
+
+def estimate_distinct(column, num_rows):
+    """GEE estimate of the number of distinct values of a column of num_rows rows, from a sample of it"""
+    try:
+        counts = column.value_counts(dropna=True)
+    except TypeError:
+        return None
+    singletons = int((counts == 1).sum())
+    return int(round(np.sqrt(num_rows / max(1, len(column))) * singletons + (len(counts) - singletons)))
+
+
+def profile_field(column, field_sample_size, num_rows=None):
+    """dtype, sample values (the smallest and largest distinct values) and distinct count of a column.
+    When num_rows is larger than the column, the column is a sample and the distinct count is an estimate."""
+
+    num_rows = len(column) if num_rows is None else num_rows
+    approximate = num_rows > len(column)
+
+    if is_typed_numeric(column):
+        present = column.dropna()
+        distinct = pd.unique(present.to_numpy())
+        if len(present) < len(column):
+            # missing values are listed once, as the largest value (set() over nans used to list them in a random order)
+            values = extreme_values(distinct, field_sample_size - 1, int(field_sample_size / 2)) + [np.float64(np.nan)]
+            num_distinct = len(distinct) + 1
+        else:
+            values = extreme_values(distinct, field_sample_size)
+            num_distinct = len(distinct)
+    elif is_typed_string(column):
+        distinct = list(pd.unique(column.dropna().to_numpy()))
+        values = extreme_values(distinct, field_sample_size)
+        num_distinct = len(distinct)
+    else:
+        try:
+            distinct = sorted([x for x in list(set(column.values)) if x != None])
+        except:
+            distinct = [x for x in list(set(column.values)) if x != None]
+        if len(distinct) <= field_sample_size:
+            values = distinct
+        else:
+            values = distinct[:int(field_sample_size / 2)] + ["..."] + distinct[-(field_sample_size - int(field_sample_size / 2)):]
+        num_distinct = len(distinct)
+
+    if approximate:
+        num_distinct = estimate_distinct(column, num_rows)
+
+    return {
+        "name": column.name,
+        "dtype": column.dtype,
+        "values": values,
+        "num_distinct": num_distinct,
+        "approximate": approximate,
+    }
+
+
+def profile_table(df, field_sample_size=7):
+    """profile every column of df, large tables are profiled on a row sample (see PROFILE_SAMPLE_ROWS)"""
+    sample = None
+    if len(df) > PROFILE_SAMPLE_ROWS:
+        sample = df.sample(n=PROFILE_SAMPLE_ROWS, random_state=0)
+
+    fields = []
+    for name in list(df.columns.values):
+        column = df[name]
+        if sample is not None and not is_typed_numeric(column):
+            fields.append(profile_field(sample[name], field_sample_size, num_rows=len(df)))
+        else:
+            fields.append(profile_field(column, field_sample_size))
+
+    return {"num_rows": len(df), "sampled": sample is not None, "fields": fields}
+
+
+def shrink_field_profile(field_profile, field_sample_size):
+    """the profile with at most field_sample_size sample values, cut from the ones it already holds (the smallest and
+    largest in order, possibly with "..." and a trailing nan for missing values in between), without profiling again"""
+    values = field_profile["values"]
+    if len(values) <= field_sample_size:
+        return field_profile
+    head_size = int(field_sample_size / 2)
+    return {**field_profile, "values": values[:head_size] + ["..."] + values[-(field_sample_size - head_size):]}
+
+
+def format_field_summary(field_profile):
+    val_str = ', '.join([str(s) if ',' not in str(s) else f'"{str(s)}"' for s in field_profile["values"]])
+    summary = f"{field_profile['name']} -- type: {field_profile['dtype']}, values: {val_str}"
+    if field_profile["approximate"] and field_profile["num_distinct"] is not None:
+        summary += f" (~{field_profile['num_distinct']} distinct values, sampled)"
+    return summary
@@ -12,23 +12,34 @@ mimetypes.add_type('application/javascript', '.mjs')
 import flask
 from flask import Flask, request, send_from_directory, redirect, url_for
 from flask import stream_with_context, Response
+from flask.json.provider import DefaultJSONProvider
 import html
 import pandas as pd
 
 import webbrowser
 import threading
+import queue
+import concurrent.futures
 
 from flask_cors import CORS
 
 import logging
 
+import gzip
+import hashlib
 import json
 import time
+import uuid
 from pathlib import Path
 import traceback
 
 from vega_datasets import data as vega_data
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from data_formulator.agents.agent_concept_derive import ConceptDeriveAgent
 from data_formulator.agents.agent_data_transform_v2 import DataTransformationAgentV2
 from data_formulator.agents.agent_data_rec import DataRecAgent
@@ -38,7 +49,14 @@ from data_formulator.agents.agent_data_load import DataLoadAgent
 from data_formulator.agents.agent_data_clean import DataCleanAgent
 from data_formulator.agents.agent_code_explanation import CodeExplanationAgent
 
-from data_formulator.agents.client_utils import Client
+from data_formulator.agents.client_utils import Client, azure_token_provider_stats
+from data_formulator.agents.completion_cache import completion_cache_stats
+import data_formulator.py_sandbox as py_sandbox
+from data_formulator.table_registry import table_registry, TableNotFoundError
+from data_formulator.cache_utils import LRUCache
+from data_formulator.compression import init_compression, COMPRESSION_LEVEL
+from data_formulator import serving
+from data_formulator.admission import admission_controller, admission_controlled
 
 from dotenv import load_dotenv
 
@@ -46,7 +64,31 @@ APP_ROOT = Path(os.path.join(Path(__file__).parent)).absolute()
 
 import os
 
+class DataFrameJSONProvider(DefaultJSONProvider):
+    """JSON provider that writes dataframes (agents keep sandbox results as dataframes) as records with 
+    DataFrame.to_json, so that result rows are serialized exactly once, when the response is encoded"""
+
+    def dumps(self, obj, **kwargs):
+        frames = {}
+        marker = uuid.uuid4().hex
+
+        def default(o):
+            if isinstance(o, pd.DataFrame):
+                key = f"__dataframe_{marker}_{len(frames)}__"
+                frames[key] = o
+                return key
+            return DefaultJSONProvider.default(o)
+
+        kwargs.setdefault("default", default)
+        text = super().dumps(obj, **kwargs)
+        for key, df in frames.items():
+            text = text.replace(f'"{key}"', df.to_json(orient="records", default_handler=str), 1)
+        return text
+
+
 app = Flask(__name__, static_url_path='', static_folder=os.path.join(APP_ROOT, "dist"))
+app.json = DataFrameJSONProvider(app)
+init_compression(app)
 CORS(app, resources={r"/*": {
     "origins": "*",
     "methods": ["GET", "POST", "OPTIONS"],
@@ -84,77 +126,166 @@ app.logger.info("Flask specific log") # Web request related logging
 
 
 
-def get_client(model_config):
+# clients are reused across requests that target the same provider configuration
+client_registry = LRUCache(max_items=64)
+
+def get_client(model_config, bypass_cache=False):
+    """the shared client of model_config, with bypass_cache (a request's "bypass_cache" flag) a view of it whose
+    completions skip the completion cache"""
     for key in model_config:
         model_config[key] = model_config[key].strip()
 
-    client = Client(
-        model_config["endpoint"],
-        model_config["model"],
-        model_config["api_key"] if "api_key" in model_config else None,
-        html.escape(model_config["api_base"]) if "api_base" in model_config else None,
-        model_config["api_version"] if "api_version" in model_config else None)
+    endpoint = model_config["endpoint"]
+    model = model_config["model"]
+    api_key = model_config["api_key"] if "api_key" in model_config else None
+    api_base = html.escape(model_config["api_base"]) if "api_base" in model_config else None
+    api_version = model_config["api_version"] if "api_version" in model_config else None
+
+    client_key = (endpoint, model, api_base, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest(), api_version)
+    client = client_registry.get(client_key)
+    if client is None:
+        client = Client(endpoint, model, api_key, api_base, api_version)
+        client_registry.put(client_key, client)
+
+    return client.with_bypass_cache(bypass_cache)
 
-    return client
+def table_not_found_response(token, err):
+    """tell the client which referenced tables have to be uploaded again through /register-table"""
+    response = flask.jsonify({ "token": token, "status": "table_not_found", "missing_table_ids": err.table_ids, "results": [] })
+    response.status_code = 404
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+def bad_request_response(token, err):
+    response = flask.jsonify({ "token": token, "status": "error", "message": str(err), "results": [] })
+    response.status_code = 400
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+# 定义我们确认能正常工作的数据集
+EXAMPLE_DATASETS = [
+    {"name": "gapminder", "challenges": [
+        {"text": "Create a line chart to show the life expectancy trend of each country over time.", "difficulty": "easy"},
+        {"text": "Visualize the top 10 countries with highest life expectancy in 2005.", "difficulty": "medium"},
+        {"text": "Find top 10 countries that have the biggest difference of life expectancy in 1955 and 2005.", "difficulty": "hard"},
+        {"text": "Rank countries by their average population per decade. Then only show countries with population over 50 million in 2005.", "difficulty": "hard"}
+    ]},
+    {"name": "income", "challenges": [
+        {"text": "Create a line chart to show the income trend of each state over time.", "difficulty": "easy"},
+        {"text": "Only show washington and california's percentage of population in each income group each year.", "difficulty": "medium"},
+        {"text": "Find the top 5 states with highest percentage of high income group in 2016.", "difficulty": "hard"}
+    ]},
+    {"name": "disasters", "challenges": [
+        {"text": "Create a scatter plot to show the number of death from each disaster type each year.", "difficulty": "easy"},
+        {"text": "Filter the data and show the number of death caused by flood or drought each year.", "difficulty": "easy"},
+        {"text": "Create a heatmap to show the total number of death caused by each disaster type each decade.", "difficulty": "hard"},
+        {"text": "Exclude 'all natural disasters' from the previous chart.", "difficulty": "medium"}
+    ]},
+    {"name": "movies", "challenges": [
+        {"text": "Create a scatter plot to show the relationship between budget and worldwide gross.", "difficulty": "easy"},
+        {"text": "Find the top 10 movies with highest profit after 2000 and visualize them in a bar chart.", "difficulty": "easy"},
+        {"text": "Visualize the median profit ratio of movies in each genre", "difficulty": "medium"},
+        {"text": "Create a scatter plot to show the relationship between profit and IMDB rating.", "difficulty": "medium"},
+        {"text": "Turn the above plot into a heatmap by bucketing IMDB rating and profit, color tiles by the number of movies in each bucket.", "difficulty": "hard"}
+    ]},
+    {"name": "unemployment-across-industries", "challenges": [
+        {"text": "Create a scatter plot to show the relationship between unemployment rate and year.", "difficulty": "easy"},
+        {"text": "Create a line chart to show the average unemployment per year for each industry.", "difficulty": "medium"},
+        {"text": "Find the 5 most stable industries (least change in unemployment rate between 2000 and 2010) and visualize their trend over time using line charts.", "difficulty": "medium"},
+        {"text": "Create a bar chart to show the unemployment rate change between 2000 and 2010, and highlight the top 5 most stable industries with least change.", "difficulty": "hard"}
+    ]}
+]
+
+# snapshot sizes the example catalog is served in, a requested max_rows is rounded down to one of them (never below
+# the smallest) so that clients cannot make the server build and keep a catalog per distinct max_rows
+EXAMPLE_CATALOG_SNAPSHOT_ROWS = [100, 1000, 10000]
+
+# the example catalog is built once per snapshot size and kept serialized and compressed, keyed by snapshot size (None = full data)
+example_catalog_payloads = LRUCache(max_items=len(EXAMPLE_CATALOG_SNAPSHOT_ROWS) + 1)
+# one lock per snapshot size, building one size does not hold up requests for the others
+example_catalog_locks = {max_rows: threading.Lock() for max_rows in [None] + EXAMPLE_CATALOG_SNAPSHOT_ROWS}
+
+def example_catalog_snapshot_rows(max_rows):
+    if max_rows is None:
+        return None
+    return max([rows for rows in EXAMPLE_CATALOG_SNAPSHOT_ROWS if rows <= max_rows], default=EXAMPLE_CATALOG_SNAPSHOT_ROWS[0])
+
+def build_example_catalog(max_rows=None):
+    """catalog of example datasets, with max_rows set each snapshot only holds the first max_rows rows 
+    (plus the total row_count) and the full data is fetched later from /vega-dataset/<name>.
+    Datasets are loaded through the vega dataset cache, so every snapshot size is cut from the same dataframes.
+    Returns the catalog and whether every dataset could be loaded."""
+    result = []
+    print(f"处理预定义的{len(EXAMPLE_DATASETS)}个数据集")
+    
+    # 只处理我们预先定义的数据集，而不是所有vega_data.list_datasets()返回的数据集
+    for dataset in EXAMPLE_DATASETS:
+        try:
+            name = dataset["name"]
+            challenges = dataset["challenges"]
+            
+            print(f"处理数据集: {name}")
+            df = load_vega_dataset(name)["df"]
+            if max_rows is None:
+                info_obj = {'name': name, 'challenges': challenges, 'snapshot': df.to_json(orient='records')}
+            else:
+                info_obj = {'name': name, 'challenges': challenges, 'snapshot': df.head(max_rows).to_json(orient='records'), 'row_count': len(df)}
+            result.append(info_obj)
+            print(f"成功处理数据集: {name}")
+        except Exception as e:
+            print(f"处理数据集 {name} 时出错: {str(e)}")
+            traceback.print_exc()
+            continue
+    
+    print(f"返回 {len(result)} 个数据集")
+    return result, len(result) == len(EXAMPLE_DATASETS)
+
+def get_example_catalog_payload(max_rows=None):
+    """serialized catalog with its gzip / brotli encodings and etag, computed on first use
+    (an incomplete catalog, e.g. when a dataset failed to download, is not kept so that the next request retries)"""
+    max_rows = example_catalog_snapshot_rows(max_rows)
+    payload = example_catalog_payloads.get(max_rows)
+    if payload is not None:
+        return payload
+    with example_catalog_locks[max_rows]:
+        payload = example_catalog_payloads.get(max_rows)
+        if payload is None:
+            catalog, complete = build_example_catalog(max_rows)
+            body = json.dumps(catalog).encode("utf-8")
+            payload = {
+                "identity": body,
+                "gzip": gzip.compress(body, compresslevel=COMPRESSION_LEVEL),
+                # same level as the response compression, brotli's default (11) takes seconds on the full catalog
+                "br": brotli.compress(body, quality=min(11, COMPRESSION_LEVEL)) if brotli is not None else None,
+                "etag": hashlib.sha256(body).hexdigest()[:32],
+            }
+            if complete:
+                example_catalog_payloads.put(max_rows, payload)
+        return payload
 
 @app.route('/vega-datasets')
 def get_example_dataset_list():
     print("正在尝试获取示例数据集列表...")
     try:
-        # 定义我们确认能正常工作的数据集
-        example_datasets = [
-            {"name": "gapminder", "challenges": [
-                {"text": "Create a line chart to show the life expectancy trend of each country over time.", "difficulty": "easy"},
-                {"text": "Visualize the top 10 countries with highest life expectancy in 2005.", "difficulty": "medium"},
-                {"text": "Find top 10 countries that have the biggest difference of life expectancy in 1955 and 2005.", "difficulty": "hard"},
-                {"text": "Rank countries by their average population per decade. Then only show countries with population over 50 million in 2005.", "difficulty": "hard"}
-            ]},
-            {"name": "income", "challenges": [
-                {"text": "Create a line chart to show the income trend of each state over time.", "difficulty": "easy"},
-                {"text": "Only show washington and california's percentage of population in each income group each year.", "difficulty": "medium"},
-                {"text": "Find the top 5 states with highest percentage of high income group in 2016.", "difficulty": "hard"}
-            ]},
-            {"name": "disasters", "challenges": [
-                {"text": "Create a scatter plot to show the number of death from each disaster type each year.", "difficulty": "easy"},
-                {"text": "Filter the data and show the number of death caused by flood or drought each year.", "difficulty": "easy"},
-                {"text": "Create a heatmap to show the total number of death caused by each disaster type each decade.", "difficulty": "hard"},
-                {"text": "Exclude 'all natural disasters' from the previous chart.", "difficulty": "medium"}
-            ]},
-            {"name": "movies", "challenges": [
-                {"text": "Create a scatter plot to show the relationship between budget and worldwide gross.", "difficulty": "easy"},
-                {"text": "Find the top 10 movies with highest profit after 2000 and visualize them in a bar chart.", "difficulty": "easy"},
-                {"text": "Visualize the median profit ratio of movies in each genre", "difficulty": "medium"},
-                {"text": "Create a scatter plot to show the relationship between profit and IMDB rating.", "difficulty": "medium"},
-                {"text": "Turn the above plot into a heatmap by bucketing IMDB rating and profit, color tiles by the number of movies in each bucket.", "difficulty": "hard"}
-            ]},
-            {"name": "unemployment-across-industries", "challenges": [
-                {"text": "Create a scatter plot to show the relationship between unemployment rate and year.", "difficulty": "easy"},
-                {"text": "Create a line chart to show the average unemployment per year for each industry.", "difficulty": "medium"},
-                {"text": "Find the 5 most stable industries (least change in unemployment rate between 2000 and 2010) and visualize their trend over time using line charts.", "difficulty": "medium"},
-                {"text": "Create a bar chart to show the unemployment rate change between 2000 and 2010, and highlight the top 5 most stable industries with least change.", "difficulty": "hard"}
-            ]}
-        ]
+        max_rows = request.args.get("max_rows", default=None, type=int)
+        payload = get_example_catalog_payload(max_rows)
 
-        result = []
-        print(f"处理预定义的{len(example_datasets)}个数据集")
-        
-        # 只处理我们预先定义的数据集，而不是所有vega_data.list_datasets()返回的数据集
-        for dataset in example_datasets:
-            try:
-                name = dataset["name"]
-                challenges = dataset["challenges"]
-                
-                print(f"处理数据集: {name}")
-                info_obj = {'name': name, 'challenges': challenges, 'snapshot': vega_data(name).to_json(orient='records')}
-                result.append(info_obj)
-                print(f"成功处理数据集: {name}")
-            except Exception as e:
-                print(f"处理数据集 {name} 时出错: {str(e)}")
-                traceback.print_exc()
-                continue
-        
-        print(f"返回 {len(result)} 个数据集")
-        response = flask.jsonify(result)
+        if payload["etag"] in request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            if payload["br"] is not None and request.accept_encodings.quality("br") > 0:
+                encoding = "br"
+            elif request.accept_encodings.quality("gzip") > 0:
+                encoding = "gzip"
+            else:
+                encoding = "identity"
+            response = flask.Response(payload[encoding], mimetype="application/json")
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+
+        response.set_etag(payload["etag"])
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["Vary"] = "Accept-Encoding"
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response
     except Exception as e:
@@ -164,23 +295,93 @@ def get_example_dataset_list():
         print(error_msg)
         return json.dumps({"error": error_msg}), 500
 
+# loaded datasets and their serialized records, bounded by VEGA_DATASET_CACHE_BYTES
+VEGA_DATASET_CACHE_BYTES = int(os.getenv("VEGA_DATASET_CACHE_BYTES", 256 * 1024 * 1024))
+VEGA_DATASET_BATCH_ROWS = 5000
+
+vega_dataset_cache = LRUCache(max_bytes=VEGA_DATASET_CACHE_BYTES)
+
+def load_vega_dataset(path):
+    """returns the cache entry {"df": ..., "records": serialized records or None} of a vega dataset"""
+    entry = vega_dataset_cache.get(path)
+    if entry is None:
+        df = vega_data(path)
+        entry = {"df": df, "records": None}
+        vega_dataset_cache.put(path, entry, int(df.memory_usage(deep=True).sum()))
+    return entry
+
+def stream_records(path, entry, offset, limit):
+    """records json of rows [offset, offset + limit), generated in batches of rows. 
+    The full table (no paging) is serialized once and then served from the cache."""
+    df = entry["df"]
+    full_table = offset == 0 and (limit is None or limit >= len(df))
+
+    if full_table and entry["records"] is not None:
+        records = entry["records"]
+        for i in range(0, len(records), 64 * 1024):
+            yield records[i: i + 64 * 1024]
+        return
+
+    stop = len(df) if limit is None else min(len(df), offset + limit)
+    parts = []
+    yield "["
+    for batch_start in range(offset, stop, VEGA_DATASET_BATCH_ROWS):
+        batch = df.iloc[batch_start: min(batch_start + VEGA_DATASET_BATCH_ROWS, stop)].to_json(orient='records')[1:-1]
+        if batch_start > offset:
+            batch = "," + batch
+        if full_table:
+            parts.append(batch)
+        yield batch
+    yield "]"
+
+    if full_table:
+        entry["records"] = "[" + "".join(parts) + "]"
+        vega_dataset_cache.put(path, entry, int(df.memory_usage(deep=True).sum()) + len(entry["records"]))
+
+def stream_columns(df, offset, limit):
+    """columnar json {"columns": [...], "data": [[...], ...], "offset": ..., "total_rows": ...} of rows [offset, offset + limit), 
+    generated one column at a time"""
+    stop = len(df) if limit is None else min(len(df), offset + limit)
+    yield '{"columns":' + json.dumps([str(c) for c in df.columns]) + ',"data":['
+    for i, column in enumerate(df.columns):
+        yield ("," if i > 0 else "") + df[column].iloc[offset:stop].to_json(orient='values')
+    yield f'],"offset":{offset},"total_rows":{len(df)}}}'
+
 @app.route('/vega-dataset/<path:path>')
 def get_datasets(path):
+    """rows of a vega dataset, optionally paged with ?offset=&limit= and in columnar form with ?format=columns"""
+    offset = max(0, request.args.get("offset", default=0, type=int))
+    limit = request.args.get("limit", default=None, type=int)
+    data_format = request.args.get("format", default="records")
     try:
-        df = vega_data(path)
-        # to_json is necessary for handle NaN issues
-        data_object = df.to_json(None, 'records')
+        entry = load_vega_dataset(path)
     except Exception as err:
         print(path)
         print(err)
-        data_object = "[]"
-    response = data_object
+        return "[]"
+
+    # to_json is necessary for handle NaN issues
+    if data_format == "columns":
+        generator = stream_columns(entry["df"], offset, limit)
+    else:
+        generator = stream_records(path, entry, offset, limit)
+
+    response = Response(stream_with_context(generator), mimetype="application/json")
+    response.headers["X-Total-Count"] = str(len(entry["df"]))
     return response
 
-@app.route('/check-available-models', methods=['GET', 'POST'])
-def check_available_models():
-    results = []
-    
+# model availability is probed concurrently and cached, stale results are served while a background refresh runs
+MODEL_CHECK_TTL = float(os.getenv("MODEL_CHECK_TTL", 600))
+MODEL_CHECK_TIMEOUT = float(os.getenv("MODEL_CHECK_TIMEOUT", 20))
+
+available_models = {"results": None, "updated_at": 0.0, "refreshing": False}
+available_models_lock = threading.Lock()
+available_models_refresh_lock = threading.Lock()
+
+def list_configured_models():
+    """model configs of every enabled provider, from the {PROVIDER}_* environment variables"""
+    model_configs = []
+
     # Define configurations for different providers
     providers = ['openai', 'azure', 'anthropic', 'gemini', 'ollama']
 
@@ -206,28 +407,80 @@ def check_available_models():
             if not model:
                 continue
 
-            model_config = {
+            model_configs.append({
                 "id": f"{provider}-{model}-{api_key}-{api_base}-{api_version}",
                 "endpoint": provider,
                 "model": model,
                 "api_key": api_key,
                 "api_base": api_base,
                 "api_version": api_version
-            }
-            
-            try:
-                client = get_client(model_config)
-                response = client.get_completion(
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": "Respond 'I can hear you.' if you can hear me."},
-                    ]
-                )
-                
-                if "I can hear you." in response.choices[0].message.content:
+            })
+
+    return model_configs
+
+def probe_model(model_config):
+    try:
+        client = get_client(dict(model_config))
+        response = client.get_completion(
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": "Respond 'I can hear you.' if you can hear me."},
+            ],
+            bypass_cache=True
+        )
+        return "I can hear you." in response.choices[0].message.content
+    except Exception as e:
+        print(f"Error testing {model_config['endpoint']} model {model_config['model']}: {e}")
+        return False
+
+def refresh_available_models(only_if_missing=False):
+    """probe all configured models concurrently, probes that do not answer within MODEL_CHECK_TIMEOUT count as unavailable.
+    With only_if_missing, results another thread stored while this one waited for the refresh lock are returned as they are."""
+    with available_models_refresh_lock:
+        try:
+            with available_models_lock:
+                if only_if_missing and available_models["results"] is not None:
+                    return available_models["results"]
+
+            model_configs = list_configured_models()
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(model_configs)))
+            futures = [executor.submit(probe_model, model_config) for model_config in model_configs]
+            concurrent.futures.wait(futures, timeout=MODEL_CHECK_TIMEOUT)
+            # do not wait for probes that timed out, their threads end with the http timeout
+            executor.shutdown(wait=False, cancel_futures=True)
+
+            results = []
+            for model_config, future in zip(model_configs, futures):
+                if future.done() and not future.cancelled() and future.exception() is None and future.result():
                     results.append(model_config)
-            except Exception as e:
-                print(f"Error testing {provider} model {model}: {e}")
+                elif not future.done():
+                    print(f"Timeout testing {model_config['endpoint']} model {model_config['model']}")
+
+            with available_models_lock:
+                available_models["results"] = results
+                available_models["updated_at"] = time.time()
+            return results
+        finally:
+            with available_models_lock:
+                available_models["refreshing"] = False
+
+def get_available_models():
+    with available_models_lock:
+        results = available_models["results"]
+        stale = time.time() - available_models["updated_at"] > MODEL_CHECK_TTL
+        if results is not None and stale and not available_models["refreshing"]:
+            available_models["refreshing"] = True
+            threading.Thread(target=refresh_available_models, daemon=True).start()
+
+    if results is None:
+        # nothing cached yet (no warm-up), this request has to wait for the probes, unless a concurrent request
+        # already got them while this one waited
+        results = refresh_available_models(only_if_missing=True)
+    return results
+
+@app.route('/check-available-models', methods=['GET', 'POST'])
+def check_available_models():
+    results = get_available_models()
     
     response = flask.Response(json.dumps(results))
     response.headers.add('Access-Control-Allow-Origin', '*')
@@ -253,7 +506,8 @@ def test_model():
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
                     {"role": "user", "content": "Respond 'I can hear you.' if you can hear me. Do not say anything other than 'I can hear you.'"},
-                ]
+                ],
+                bypass_cache=True
             )
 
             logger.info(f"model: {content['model']}")
@@ -366,7 +620,27 @@ def streamed_response():
 
 ###### agent related functions ######
 
+@app.route('/register-table', methods=['POST'])
+def register_table():
+    """upload a table once, agent requests can then reference it as {"name": ..., "table_id": ...} instead of sending its rows"""
+
+    if request.is_json:
+        content = request.get_json()
+        try:
+            table_id = table_registry.register(content["rows"])
+            response = flask.jsonify({ "status": "ok", "name": content.get("name", ""), "table_id": table_id, "num_rows": len(content["rows"]) })
+        except ValueError as err:
+            response = flask.jsonify({ "status": "error", "message": str(err) })
+            response.status_code = 413
+    else:
+        response = flask.jsonify({ "status": "error", "message": "expecting a json body with table rows" })
+        response.status_code = 400
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
 @app.route('/process-data-on-load', methods=['GET', 'POST'])
+@admission_controlled
 def process_data_on_load_request():
 
     if request.is_json:
@@ -374,12 +648,17 @@ def process_data_on_load_request():
         content = request.get_json()
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
         app.logger.info(f" model: {content['model']}")
+
+        try:
+            [input_data] = table_registry.resolve_input_tables([content["input_data"]])
+        except TableNotFoundError as err:
+            return table_not_found_response(token, err)
         
         agent = DataLoadAgent(client=client)
-        candidates = agent.run(content["input_data"])
+        candidates = agent.run(input_data)
         
         candidates = [c['content'] for c in candidates if c['status'] == 'ok']
 
@@ -392,6 +671,7 @@ def process_data_on_load_request():
 
 
 @app.route('/derive-concept-request', methods=['GET', 'POST'])
+@admission_controlled
 def derive_concept_request():
 
     if request.is_json:
@@ -399,7 +679,7 @@ def derive_concept_request():
         content = request.get_json()
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
         app.logger.info(f" model: {content['model']}")
         agent = ConceptDeriveAgent(client=client)
@@ -420,6 +700,7 @@ def derive_concept_request():
 
 
 @app.route('/clean-data', methods=['GET', 'POST'])
+@admission_controlled
 def clean_data_request():
 
     if request.is_json:
@@ -427,7 +708,7 @@ def clean_data_request():
         content = request.get_json()
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
         app.logger.info(f" model: {content['model']}")
         
@@ -446,6 +727,7 @@ def clean_data_request():
 
 
 @app.route('/codex-sort-request', methods=['GET', 'POST'])
+@admission_controlled
 def sort_data_request():
 
     if request.is_json:
@@ -453,7 +735,7 @@ def sort_data_request():
         content = request.get_json()
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
         agent = SortDataAgent(client=client)
         candidates = agent.run(content['field'], content['items'])
@@ -468,62 +750,105 @@ def sort_data_request():
     return response
 
 
-@app.route('/derive-data', methods=['GET', 'POST'])
-def derive_data():
+class DeriveCancelled(Exception):
+    """raised inside a streamed derivation once its client has disconnected"""
 
-    if request.is_json:
-        app.logger.info("# request data: ")
-        content = request.get_json()        
-        token = content["token"]
 
-        client = get_client(content['model'])
+# candidates a derivation may ask for (each is a completion plus a sandbox run, all within one admission slot)
+DERIVE_MAX_CANDIDATES = int(os.getenv("DERIVE_MAX_CANDIDATES", 4))
 
-        # each table is a dict with {"name": xxx, "rows": [...]}
-        input_tables = content["input_tables"]
-        new_fields = content["new_fields"]
-        instruction = content["extra_prompt"]
+def requested_candidates(content):
+    """number of candidates (n) of a derive request, capped at DERIVE_MAX_CANDIDATES,
+    raises ValueError when it is not a positive integer"""
+    n = content.get("n", 1)
+    if not isinstance(n, int) or isinstance(n, bool) or n <= 0:
+        raise ValueError(f"n must be a positive integer, got {n!r}")
+    return min(n, DERIVE_MAX_CANDIDATES)
 
-        max_repair_attempts = content["max_repair_attempts"] if "max_repair_attempts" in content else 1
 
-        if "additional_messages" in content:
-            prev_messages = content["additional_messages"]
-        else:
-            prev_messages = []
+def run_derive_data(client, content, input_tables, on_event=None, cancelled=None):
+    """run the transformation (or recommendation) agent on the request content, repairing failed code
+    up to max_repair_attempts times. on_event(event, payload) receives progress events, the loop stops
+    early once the cancelled event is set"""
 
-        logger.info("== input tables ===>")
-        for table in input_tables:
-            logger.info(f"===> Table: {table['name']} (first 5 rows)")
-            logger.info(table['rows'][:5])
+    new_fields = content["new_fields"]
+    instruction = content["extra_prompt"]
+
+    max_repair_attempts = content["max_repair_attempts"] if "max_repair_attempts" in content else 1
+    # number of candidates generated (and executed) per attempt, validated by the routes
+    n = requested_candidates(content)
+
+    if "additional_messages" in content:
+        prev_messages = content["additional_messages"]
+    else:
+        prev_messages = []
+
+    logger.info("== input tables ===>")
+    for table in input_tables:
+        logger.info(f"===> Table: {table['name']} (first 5 rows)")
+        logger.info(table['rows'][:5])
+
+    logger.info("== user spec ===")
+    logger.info(new_fields)
+    logger.info(instruction)
+
+    mode = "transform"
+    if len(new_fields) == 0:
+        mode = "recommendation"
+
+    if mode == "recommendation":
+        # now it's in recommendation mode
+        agent = DataRecAgent(client=client, on_event=on_event, records=False)
+        results = agent.run(input_tables, instruction, n=n)
+    else:
+        agent = DataTransformationAgentV2(client=client, on_event=on_event, records=False)
+        results = agent.run(input_tables, instruction, [field['name'] for field in new_fields], prev_messages, n=n)
 
-        logger.info("== user spec ===")
-        logger.info(new_fields)
-        logger.info(instruction)
+    repair_attempts = 0
+    while results[0]['status'] == 'error' and repair_attempts < max_repair_attempts: # try up to n times
+        if cancelled is not None and cancelled.is_set():
+            break
 
-        mode = "transform"
-        if len(new_fields) == 0:
-            mode = "recommendation"
+        error_message = results[0]['content']
+        new_instruction = f"We run into the following problem executing the code, please fix it:\n\n{error_message}\n\nPlease think step by step, reflect why the error happens and fix the code so that no more errors would occur."
 
+        prev_dialog = results[0]['dialog']
+
+        repair_attempts += 1
+        if on_event is not None:
+            on_event("repair", {"repair_attempt": repair_attempts, "error": error_message})
+
+        if mode == "transform":
+            results = agent.followup(input_tables, prev_dialog, [field['name'] for field in new_fields], new_instruction, n=n)
         if mode == "recommendation":
-            # now it's in recommendation mode
-            agent = DataRecAgent(client=client)
-            results = agent.run(input_tables, instruction)
-        else:
-            agent = DataTransformationAgentV2(client=client)
-            results = agent.run(input_tables, instruction, [field['name'] for field in new_fields], prev_messages)
+            results = agent.followup(input_tables, prev_dialog, new_instruction, n=n)
 
-        repair_attempts = 0
-        while results[0]['status'] == 'error' and repair_attempts < max_repair_attempts: # try up to n times
-            error_message = results[0]['content']
-            new_instruction = f"We run into the following problem executing the code, please fix it:\n\n{error_message}\n\nPlease think step by step, reflect why the error happens and fix the code so that no more errors would occur."
+    return results
 
-            prev_dialog = results[0]['dialog']
 
-            if mode == "transform":
-                results = agent.followup(input_tables, prev_dialog, [field['name'] for field in new_fields], new_instruction)
-            if mode == "recommendation":
-                results = agent.followup(input_tables, prev_dialog, new_instruction)
+@app.route('/derive-data', methods=['GET', 'POST'])
+@admission_controlled
+def derive_data():
 
-            repair_attempts += 1
+    if request.is_json:
+        app.logger.info("# request data: ")
+        content = request.get_json()        
+        token = content["token"]
+
+        try:
+            requested_candidates(content)
+        except ValueError as err:
+            return bad_request_response(token, err)
+
+        client = get_client(content['model'], content.get("bypass_cache") is True)
+
+        # each table is a dict with {"name": xxx, "rows": [...]} or {"name": xxx, "table_id": xxx}
+        try:
+            input_tables = table_registry.resolve_input_tables(content["input_tables"])
+        except TableNotFoundError as err:
+            return table_not_found_response(token, err)
+
+        results = run_derive_data(client, content, input_tables)
         
         response = flask.jsonify({ "token": token, "status": "ok", "results": results })
     else:
@@ -532,7 +857,75 @@ def derive_data():
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
+@app.route('/derive-data-stream', methods=['POST'])
+@admission_controlled
+def derive_data_stream():
+    """same request as /derive-data, answered as a stream of server-sent events while the agent works: prompt, 
+    tokens, refined_goal and code (as soon as they are complete in the token stream), sandbox_start, sandbox_result, 
+    candidate (the first working candidate, as soon as it is ready) and repair, then a final result event with the 
+    same payload /derive-data returns (or an error event). Closing the connection abandons the derivation."""
+
+    if not request.is_json:
+        return flask.jsonify({ "token": "", "status": "error", "results": [] }), 400
+
+    content = request.get_json()
+    token = content["token"]
+
+    try:
+        requested_candidates(content)
+    except ValueError as err:
+        return bad_request_response(token, err)
+
+    client = get_client(content['model'], content.get("bypass_cache") is True)
+
+    try:
+        input_tables = table_registry.resolve_input_tables(content["input_tables"])
+    except TableNotFoundError as err:
+        return table_not_found_response(token, err)
+
+    events = queue.Queue()
+    cancelled = threading.Event()
+    state = {"attempt": 0}
+
+    def on_event(event, payload):
+        if cancelled.is_set():
+            raise DeriveCancelled()
+        if event == "repair":
+            state["attempt"] = payload["repair_attempt"]
+        events.put((event, {"attempt": state["attempt"], **payload}))
+
+    def derive():
+        try:
+            results = run_derive_data(client, content, input_tables, on_event, cancelled)
+            events.put(("result", { "token": token, "status": "ok", "results": results }))
+        except DeriveCancelled:
+            logger.info(f"derivation {token} abandoned by the client")
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            events.put(("error", { "token": token, "status": "error", "message": f"{type(e).__name__}: {e}" }))
+        finally:
+            events.put((None, None))
+
+    def generate():
+        worker = threading.Thread(target=derive, daemon=True)
+        worker.start()
+        try:
+            while True:
+                event, payload = events.get()
+                if event is None:
+                    break
+                yield f"event: {event}\ndata: {app.json.dumps(payload)}\n\n"
+        finally:
+            cancelled.set()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
 @app.route('/refine-data', methods=['GET', 'POST'])
+@admission_controlled
 def refine_data():
 
     if request.is_json:
@@ -540,10 +933,13 @@ def refine_data():
         content = request.get_json()        
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
-        # each table is a dict with {"name": xxx, "rows": [...]}
-        input_tables = content["input_tables"]
+        # each table is a dict with {"name": xxx, "rows": [...]} or {"name": xxx, "table_id": xxx}
+        try:
+            input_tables = table_registry.resolve_input_tables(content["input_tables"])
+        except TableNotFoundError as err:
+            return table_not_found_response(token, err)
         output_fields = content["output_fields"]
         dialog = content["dialog"]
         new_instruction = content["new_instruction"]
@@ -559,7 +955,7 @@ def refine_data():
         logger.info(new_instruction)
 
         # always resort to the data transform agent       
-        agent = DataTransformationAgentV2(client=client)
+        agent = DataTransformationAgentV2(client=client, records=False)
         results = agent.followup(input_tables, dialog, [field['name'] for field in output_fields], new_instruction)
 
         repair_attempts = 0
@@ -579,16 +975,20 @@ def refine_data():
     return response
 
 @app.route('/code-expl', methods=['GET', 'POST'])
+@admission_controlled
 def request_code_expl():
     if request.is_json:
         app.logger.info("# request data: ")
         content = request.get_json()        
         token = content["token"]
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], content.get("bypass_cache") is True)
 
-        # each table is a dict with {"name": xxx, "rows": [...]}
-        input_tables = content["input_tables"]
+        # each table is a dict with {"name": xxx, "rows": [...]} or {"name": xxx, "table_id": xxx}
+        try:
+            input_tables = table_registry.resolve_input_tables(content["input_tables"])
+        except TableNotFoundError as err:
+            return table_not_found_response(token, err)
         code = content["code"]
         
         code_expl_agent = CodeExplanationAgent(client=client)
@@ -597,6 +997,28 @@ def request_code_expl():
         expl = ""
     return expl
 
+@app.route('/admission-stats', methods=['GET'])
+def get_admission_stats():
+    """running and waiting agent requests of this server process, see data_formulator.admission"""
+    response = flask.jsonify(admission_controller.stats())
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/sandbox-stats', methods=['GET'])
+def get_sandbox_stats():
+    """hit rate and memory use of the sandbox result cache (null when it is disabled)"""
+    response = flask.jsonify({ "result_cache": py_sandbox.sandbox_result_cache_stats() })
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/llm-stats', methods=['GET'])
+def get_llm_stats():
+    """completion cache hit rates (null when it is disabled) and token acquisitions of the shared azure token providers
+    of this server process"""
+    response = flask.jsonify({ "completion_cache": completion_cache_stats(), "azure_token_providers": azure_token_provider_stats() })
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
 @app.route('/app-config', methods=['GET', 'OPTIONS'])
 def get_app_config():
     """Provide frontend configuration settings from environment variables"""
@@ -623,16 +1045,32 @@ def get_app_config():
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="AI图表")
     parser.add_argument("-p", "--port", type=int, default=5656, help="The port number you want to use")
+    parser.add_argument("--host", default="0.0.0.0", help="The interface to listen on")
+    parser.add_argument("--no-browser", action="store_true", help="Do not open the app in a browser")
+    serving.add_server_arguments(parser)
     return parser.parse_args()
 
 
 def run_app():
     args = parse_args()
 
-    url = "http://localhost:{0}".format(args.port)
-    threading.Timer(2, lambda: webbrowser.open(url, new=2)).start()
+    if args.production:
+        serving.serve(args)
+        return
+
+    # start the sandbox workers ahead of the first request
+    sandbox_pool = py_sandbox.get_sandbox_pool()
+    if sandbox_pool is not None:
+        sandbox_pool.warm_up()
+
+    if os.getenv("MODEL_CHECK_WARMUP", "false").lower() == "true":
+        threading.Thread(target=refresh_available_models, daemon=True).start()
+
+    if not args.no_browser:
+        url = "http://localhost:{0}".format(args.port)
+        threading.Timer(2, lambda: webbrowser.open(url, new=2)).start()
 
-    app.run(host='0.0.0.0', port=args.port, threaded=True)
+    app.run(host=args.host, port=args.port, threaded=True)
     
 if __name__ == '__main__':
     #app.run(debug=True, host='127.0.0.1', port=5000)
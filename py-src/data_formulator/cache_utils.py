@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """thread-safe LRU cache bounded by number of entries and/or total size (sizes are reported by the caller
+    on put), entries optionally expire after ttl seconds. on_evict(key, value) is called (outside the lock) 
+    for every entry evicted to make room, e.g. to release resources the value holds."""
+
+    def __init__(self, max_items=None, max_bytes=None, ttl=None, on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+        self.entries = OrderedDict() # key -> (value, nbytes, created_at)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _remove(self, key):
+        _, nbytes, _ = self.entries.pop(key)
+        self.total_bytes -= nbytes
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                value, _, created_at = self.entries[key]
+                if not self._expired(created_at):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value, nbytes=0):
+        """insert value, returns False if the value alone is larger than the cache"""
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return False
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, nbytes, time.time())
+            self.total_bytes += nbytes
+            while len(self.entries) > 1 and ((self.max_items is not None and len(self.entries) > self.max_items)
+                                             or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                evicted_key = next(iter(self.entries))
+                evicted.append((evicted_key, self.entries[evicted_key][0]))
+                self._remove(evicted_key)
+                self.evictions += 1
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+        return True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries[key][0]
+                self._remove(key)
+                return value
+            return default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries and not self._expired(self.entries[key][2])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this are sent as they are
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", 1024))
+# gzip level (1-9), brotli quality is derived from it
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+
+COMPRESSIBLE_MIMETYPES = ["application/json", "application/javascript", "text/event-stream", "text/html", "text/plain", "text/csv"]
+
+
+class StreamCompressor(object):
+    """incremental gzip / brotli compressor, every chunk is flushed so that streamed events reach the client right away"""
+
+    def __init__(self, encoding, level=COMPRESSION_LEVEL):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=min(11, level))
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        if self.encoding == "br":
+            return self.compressor.process(data) + (self.compressor.flush() if flush else b"")
+        return self.compressor.compress(data) + (self.compressor.flush(zlib.Z_SYNC_FLUSH) if flush else b"")
+
+    def finish(self):
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+def choose_encoding():
+    if brotli is not None and request.accept_encodings.quality("br") > 0:
+        return "br"
+    if request.accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def compress_stream(chunks, compressor, charset="utf-8"):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk, flush=True)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """after_request hook: gzip / brotli encode compressible responses, negotiated by Accept-Encoding.
+    Buffered bodies are compressed when larger than COMPRESSION_MIN_BYTES, streamed bodies are compressed chunk by chunk."""
+
+    if response.status_code < 200 or response.status_code >= 300 or response.status_code == 204 \
+            or response.direct_passthrough or "Content-Encoding" in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    encoding = choose_encoding()
+    response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, StreamCompressor(encoding))
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            return response
+        compressor = StreamCompressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
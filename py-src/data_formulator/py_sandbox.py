@@ -2,10 +2,189 @@
 # Licensed under the MIT License.
 
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 from sys import addaudithook
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import ast
+import datetime
+import functools
+import hashlib
+import json
+import math
+import mmap
+import os
+import pickle
+import queue
+import select
+import signal
+import tempfile
+import threading
+import time
 import traceback
 import warnings
 
+import numpy as np
+import pandas as pd
+
+from data_formulator.cache_utils import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# number of warm sandbox workers kept around, each forks a fresh child per job (0 disables the pool and spawns one process per call)
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", min(4, os.cpu_count() or 1)))
+# a job running longer is killed and reported as a TimeoutError
+SANDBOX_JOB_TIMEOUT = float(os.getenv("SANDBOX_JOB_TIMEOUT", 120))
+# tables with at least this many rows are handed to the sandbox through a memory-mapped columnar file
+SANDBOX_SHM_MIN_ROWS = int(os.getenv("SANDBOX_SHM_MIN_ROWS", 20000))
+# number of leading rows on which a vectorized derive has to reproduce the row-wise results
+DERIVE_VALIDATION_ROWS = int(os.getenv("DERIVE_VALIDATION_ROWS", 50))
+# row-wise derive/filter code on tables larger than this is split into row chunks executed in parallel workers
+SANDBOX_CHUNK_ROWS = int(os.getenv("SANDBOX_CHUNK_ROWS", 50000))
+# maximum number of chunks of one table executed at the same time
+SANDBOX_MAX_PARALLEL_CHUNKS = int(os.getenv("SANDBOX_MAX_PARALLEL_CHUNKS", max(1, SANDBOX_POOL_SIZE)))
+SANDBOX_SHM_DIR = os.getenv("SANDBOX_SHM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+# results of identical (code, inputs) executions are reused, 0 items disables the cache
+SANDBOX_RESULT_CACHE_MAX_ITEMS = int(os.getenv("SANDBOX_RESULT_CACHE_MAX_ITEMS", 256))
+SANDBOX_RESULT_CACHE_MAX_BYTES = int(os.getenv("SANDBOX_RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+RESULT_ALIGNMENT = 64
+
+
+def json_default(o):
+    if o is None or o is pd.NaT or o is pd.NA:
+        return None
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, (pd.Timestamp, datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    return str(o)
+
+
+def encode_column(values, parts):
+    """column spec of a pandas Series, its data is appended to parts: typed columns as their raw numpy buffer,
+    everything else as a json list of plain values"""
+    spec = {'dtype': str(values.dtype)}
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        data = values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+        spec['tz'] = str(values.dtype.tz)
+    elif isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufcmM':
+        data = values.to_numpy()
+    else:
+        data = None
+
+    if data is not None:
+        spec.update({'kind': 'buffer', 'dtype': data.dtype.str})
+        parts.append(np.ascontiguousarray(data).tobytes())
+    else:
+        spec['kind'] = 'json'
+        parts.append(json.dumps(values.astype(object).tolist(), default=json_default).encode('utf-8'))
+    return spec
+
+
+def decode_column(spec, payload, offset, num_rows):
+    if spec['kind'] == 'buffer':
+        dtype = np.dtype(spec['dtype'])
+        data = np.frombuffer(payload, dtype=dtype, count=num_rows, offset=offset).copy() if num_rows > 0 else np.empty(0, dtype)
+        if 'tz' in spec:
+            return pd.Series(data).dt.tz_localize('UTC').dt.tz_convert(spec['tz'])
+        return pd.Series(data)
+    values = pd.Series(json.loads(payload[offset: offset + spec['nbytes']]), dtype=object)
+    if spec['dtype'] != 'object':
+        try:
+            return values.astype(spec['dtype'])
+        except Exception:
+            pass
+    return values.infer_objects()
+
+
+def encode_result(status, content=None, transient=False):
+    """Encode the result of a sandbox job as bytes, so that the server never unpickles objects created by the
+    sandboxed code: an 8-byte header length, a json header (status, schema) and the column data (see encode_column).
+    Only dataframes and series are passed through, for other objects just their type name is reported."""
+    header = {'status': status}
+    parts = []
+    if status != 'ok':
+        header['content'] = str(content)
+        header['transient'] = transient
+    elif isinstance(content, (pd.DataFrame, pd.Series)):
+        frame = content.to_frame() if isinstance(content, pd.Series) else content
+        header['kind'] = 'series' if isinstance(content, pd.Series) else 'frame'
+        header['unnamed'] = isinstance(content, pd.Series) and content.name is None
+        header['num_rows'] = len(frame)
+        header['names'] = [list(name) if isinstance(name, tuple) else name for name in frame.columns]
+        header['multi_columns'] = isinstance(frame.columns, pd.MultiIndex)
+        header['columns'] = [encode_column(frame.iloc[:, i], parts) for i in range(frame.shape[1])]
+        if isinstance(frame.index, pd.RangeIndex) or isinstance(frame.index, pd.MultiIndex):
+            index = frame.index if isinstance(frame.index, pd.RangeIndex) else pd.RangeIndex(len(frame))
+            header['index'] = {'kind': 'range', 'start': index.start, 'stop': index.stop, 'step': index.step}
+        else:
+            header['index'] = encode_column(frame.index.to_series(), parts)
+        header['attrs'] = {str(k): v for k, v in content.attrs.items() if v is None or isinstance(v, (str, int, float, bool))}
+    else:
+        header = {'status': 'ok', 'kind': 'other', 'type': type(content).__name__}
+
+    offset = 0
+    specs = header.get('columns', []) + ([header['index']] if 'index' in header and header['index'].get('kind') != 'range' else [])
+    padded = []
+    for spec, data in zip(specs, parts):
+        padding = -offset % RESULT_ALIGNMENT
+        padded.append(b'\0' * padding)
+        offset += padding
+        spec['offset'] = offset
+        spec['nbytes'] = len(data)
+        padded.append(data)
+        offset += len(data)
+
+    header_bytes = json.dumps(header, default=json_default).encode('utf-8')
+    return len(header_bytes).to_bytes(8, 'little') + header_bytes + b''.join(padded)
+
+
+def decode_result(payload):
+    """decode bytes written by encode_result into {'status': ..., 'content': ...}, without unpickling anything"""
+    header_size = int.from_bytes(payload[:8], 'little')
+    header = json.loads(payload[8: 8 + header_size])
+    base = 8 + header_size
+
+    if header['status'] != 'ok':
+        result = {'status': header['status'], 'content': header['content']}
+        if header.get('transient'):
+            result['transient'] = True
+        return result
+    if header['kind'] == 'other':
+        return {'status': 'error', 'content': f"Error: TypeError - the function should return a pandas DataFrame, got {header['type']}"}
+
+    num_rows = header['num_rows']
+    columns = [decode_column(spec, payload, base + spec['offset'], num_rows) for spec in header['columns']]
+    if header['index']['kind'] == 'range':
+        index = pd.RangeIndex(header['index']['start'], header['index']['stop'], header['index']['step'])
+    else:
+        index = pd.Index(decode_column(header['index'], payload, base + header['index']['offset'], num_rows))
+    names = header['names']
+    if header['multi_columns']:
+        names = pd.MultiIndex.from_tuples([tuple(name) for name in names])
+
+    frame = pd.concat(columns, axis=1) if len(columns) > 0 else pd.DataFrame(index=pd.RangeIndex(num_rows))
+    frame.columns = names
+    frame.index = index
+    if header['kind'] == 'series':
+        content = frame.iloc[:, 0].rename(None if header['unnamed'] else names[0])
+    else:
+        content = frame
+    content.attrs.update(header['attrs'])
+    return {'status': 'ok', 'content': content}
+
+
+def sandbox_result_bytes(allowed_objects, output_var_name):
+    """runs inside the sandbox"""
+    try:
+        return encode_result('ok', allowed_objects[output_var_name])
+    except Exception as err:
+        return encode_result('error', f"Error: {type(err).__name__} - {str(err)}")
+
+
 ## ---------------- The sandbox implementation follows, not to be changed --------------------
 
 def ran_in_subprocess(code, allowed_objects, conn, output_var_name):
@@ -39,105 +218,714 @@ def ran_in_subprocess(code, allowed_objects, conn, output_var_name):
         exec(code, allowed_objects)
     except Exception as err:
         error_message = f"Error: {type(err).__name__} - {str(err)}"
-        conn.send({'status': 'error', 'content': error_message})
+        conn.send_bytes(encode_result('error', error_message, transient=isinstance(err, MemoryError)))
         conn.close()
         return allowed_objects
 
-    conn.send({'status': 'ok', 'content': allowed_objects[output_var_name]})
+    conn.send_bytes(sandbox_result_bytes(allowed_objects, output_var_name))
     conn.close()
     return allowed_objects
 
+def run_forked_job(conn, code, allowed_objects, output_var_name, write_fd):
+    """body of the per-job child forked by sandbox_worker_loop, writes the encoded result to write_fd and exits"""
+    try:
+        # own process group, so that anything the job spawns is killed along with it
+        os.setpgid(0, 0)
+        conn.close()
+        try:
+            exec(code, allowed_objects)
+            payload = sandbox_result_bytes(allowed_objects, output_var_name)
+        except BaseException as err:
+            payload = encode_result('error', f"Error: {type(err).__name__} - {str(err)}", transient=isinstance(err, MemoryError))
+        # plain os.write, the audit hook forbids opening files for writing. The length prefix lets the parent
+        # stop reading once the result is complete, even if processes spawned by the job keep the pipe open
+        view = memoryview(len(payload).to_bytes(8, 'little') + payload)
+        while len(view) > 0:
+            view = view[os.write(write_fd, view):]
+    finally:
+        os._exit(0)
+
+
+def collect_forked_job(pid, read_fd, timeout):
+    """read the result of a forked job, the job's process group is killed after timeout seconds"""
+    received = bytearray()
+    expected = None
+    deadline = time.monotonic() + timeout
+    timed_out = False
+    while expected is None or len(received) < expected:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        ready, _, _ = select.select([read_fd], [], [], remaining)
+        if ready:
+            data = os.read(read_fd, 1 << 20)
+            if not data:
+                break
+            received += data
+            if expected is None and len(received) >= 8:
+                expected = 8 + int.from_bytes(received[:8], 'little')
+    os.close(read_fd)
+
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    _, status = os.waitpid(pid, 0)
+
+    if timed_out:
+        return encode_result('error', f"Error: TimeoutError - the code did not finish within {timeout} seconds", transient=True)
+    if expected is None or len(received) < expected:
+        return encode_result('error', f"Error: SandboxError - the sandbox process exited unexpectedly (status {status})", transient=True)
+    return bytes(memoryview(received)[8:])
+
+
+def sandbox_worker_loop(conn, timeout):
+    """Pre-forked sandbox parent: pandas/numpy are imported and the audit hook is installed once, then every job
+    (script, allowed_objects, output_var_name) received from conn runs in a fresh child forked from this warm process,
+    so nothing a job changes in the interpreter is seen by the next one. The child's encoded result is relayed to conn.
+    The parent itself never executes job code, it serves jobs until it receives None.
+    """
+    warnings.filterwarnings('ignore')
+
+    # warm up the heavy imports before the audit hook is in place, executed scripts re-import them for free
+    import json
+    import numpy
+    import pandas
+
+    def block_mischief(event,arg):
+        if type(event) != str: raise
+        # see the security note in ran_in_subprocess, the same applies to the pooled worker
+        if event=='open' and type(arg[1])==str and arg[1]!='r':
+            print('\taudit:', event, arg)
+            raise IOError('file write forbidden')
+        if event.split('.')[0] in ['subprocess', 'shutil', 'winreg']:
+            print('\taudit:', event, arg)
+            raise IOError('potentially dangerous, filesystem-accessing functions forbidden')
+
+    addaudithook(block_mischief)
+    del(block_mischief)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        code, allowed_objects, output_var_name = job
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            run_forked_job(conn, code, allowed_objects, output_var_name, write_fd)
+        os.close(write_fd)
+        # drop the job right away so that mapped input tables are released
+        del job, code, allowed_objects
+
+        conn.send_bytes(collect_forked_job(pid, read_fd, timeout))
+
+    conn.close()
+
+
+class SandboxWorker(object):
+    """handle to one warm, pre-forked sandbox parent (see sandbox_worker_loop)"""
+
+    def __init__(self, timeout=SANDBOX_JOB_TIMEOUT):
+        self.timeout = timeout
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=sandbox_worker_loop, args=(child_conn, timeout), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.broken = False
+
+    def run(self, script_str, allowed_objects, output_var_name):
+        self.conn.send((script_str, allowed_objects, output_var_name))
+        # wait() goes through select, so the caller only blocks on the pipe becoming readable.
+        # The parent enforces the job timeout itself, the margin only catches a parent that stopped responding.
+        if not wait([self.conn], self.timeout + 30):
+            self.broken = True
+            return {'status': 'error', 'content': f"Error: TimeoutError - the sandbox did not respond within {self.timeout} seconds", 'transient': True}
+        return decode_result(self.conn.recv_bytes())
+
+    def is_alive(self):
+        return not self.broken and self.process.is_alive()
+
+    def shutdown(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class SandboxWorkerPool(object):
+    """a fixed-size pool of warm sandbox workers, callers queue up when every worker is busy.
+    Jobs run in fresh children of the workers, a worker is only replaced when it died or stopped responding."""
+
+    def __init__(self, size=SANDBOX_POOL_SIZE):
+        self.size = size
+        self.idle_workers = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_workers = 0
+
+    def warm_up(self):
+        """start all workers ahead of time so that the first requests do not pay for process startup"""
+        while self._try_reserve_slot():
+            self.idle_workers.put(SandboxWorker())
+
+    def _try_reserve_slot(self):
+        with self.lock:
+            if self.num_workers < self.size:
+                self.num_workers += 1
+                return True
+            return False
+
+    def _acquire(self):
+        try:
+            return self.idle_workers.get_nowait()
+        except queue.Empty:
+            pass
+        if self._try_reserve_slot():
+            return SandboxWorker()
+        # bounded: every job holding a worker is killed after SANDBOX_JOB_TIMEOUT
+        return self.idle_workers.get()
+
+    def _release(self, worker):
+        if not worker.is_alive():
+            worker.shutdown()
+            # spawn the replacement right away so the next caller finds a warm worker
+            worker = SandboxWorker()
+        self.idle_workers.put(worker)
+
+    def run(self, script_str, allowed_objects, output_var_name='output'):
+        worker = self._acquire()
+        try:
+            return worker.run(script_str, allowed_objects, output_var_name)
+        except (EOFError, OSError):
+            # the worker died (or its pipe broke) mid-job, _release replaces it and the job fails like a crashed subprocess
+            worker.broken = True
+            logger.warning("sandbox worker exited unexpectedly, replacing it")
+            return {'status': 'error', 'content': "Error: SandboxError - the sandbox process exited unexpectedly", 'transient': True}
+        finally:
+            self._release(worker)
+
+    def shutdown(self):
+        with self.lock:
+            self.size = 0
+        while True:
+            try:
+                worker = self.idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            worker.shutdown()
+
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+def get_sandbox_pool():
+    """the process-wide sandbox worker pool, or None when pooling is disabled (SANDBOX_POOL_SIZE=0)
+    or not available (no os.fork, e.g. on windows)"""
+    global _sandbox_pool
+    if SANDBOX_POOL_SIZE <= 0 or not hasattr(os, "fork"):
+        return None
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None:
+            _sandbox_pool = SandboxWorkerPool()
+        return _sandbox_pool
+
+
+def run_in_sandbox(script_str, allowed_objects, output_var_name='output'):
+    """execute script_str with allowed_objects as its globals, in a fresh child of a pooled worker when available,
+    otherwise in a fresh subprocess, and return {'status': ..., 'content': ...}.
+    Failures that do not depend on the code and inputs (timeouts, crashes, MemoryError) are marked 'transient'."""
+
+    pool = get_sandbox_pool()
+    if pool is not None:
+        return pool.run(script_str, allowed_objects, output_var_name)
+
+    parent_conn, child_conn = Pipe()
+    p = Process(target=ran_in_subprocess, args=(script_str, allowed_objects, child_conn, output_var_name))
+    p.start()
+    child_conn.close()
+
+    ## NOTE: The sandbox is probably safe against file writing, as well as against access into the main process.
+    ## Results come back as plain bytes (see encode_result) and are decoded without unpickling, so objects created
+    ## by the sandboxed code never reach the server.
+    try:
+        if not parent_conn.poll(SANDBOX_JOB_TIMEOUT):
+            p.kill()
+            result = {'status': 'error', 'content': f"Error: TimeoutError - the code did not finish within {SANDBOX_JOB_TIMEOUT} seconds", 'transient': True}
+        else:
+            result = decode_result(parent_conn.recv_bytes())
+    except EOFError:
+        result = {'status': 'error', 'content': "Error: SandboxError - the sandbox process exited unexpectedly", 'transient': True}
+    finally:
+        parent_conn.close()
+    p.join()
+    return result
+
+
+class SharedTable(object):
+    """a table written once by the server into a memory-mapped file in columnar layout. 
+    The sandbox maps the file copy-on-write: numeric columns are used in place without building 
+    per-row python objects, and in-place edits by the generated code stay private to the sandbox."""
+
+    ALIGNMENT = 64
+
+    def __init__(self, path, num_rows, columns):
+        self.path = path
+        self.num_rows = num_rows
+        self.columns = columns
+
+    @staticmethod
+    def write(df):
+        fd, path = tempfile.mkstemp(prefix="data-formulator-", suffix=".table", dir=SANDBOX_SHM_DIR)
+        columns = []
+        offset = 0
+        with os.fdopen(fd, 'wb') as f:
+            for name in df.columns:
+                values = df[name].values
+                if isinstance(values, np.ndarray) and values.dtype.kind in 'biufcmM':
+                    values = np.ascontiguousarray(values)
+                    data = values.view(np.uint8)
+                    spec = {'name': name, 'kind': 'buffer', 'dtype': values.dtype.str}
+                else:
+                    # strings and other python objects cannot be mapped, they are stored as a pickled column
+                    data = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+                    spec = {'name': name, 'kind': 'pickle'}
+                padding = -offset % SharedTable.ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                f.write(data)
+                spec['offset'] = offset
+                spec['nbytes'] = len(data)
+                offset += len(data)
+                columns.append(spec)
+        return SharedTable(path, len(df), columns)
+
+    def load(self):
+        """map the table into a dataframe, runs inside the sandbox"""
+        # os.open (rather than open) keeps the read-only access within what the sandbox audit hook allows
+        fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            size = os.fstat(fd).st_size
+            buffer = mmap.mmap(fd, size, access=mmap.ACCESS_COPY) if size > 0 else b''
+        finally:
+            os.close(fd)
+
+        data = {}
+        for spec in self.columns:
+            if spec['kind'] == 'buffer':
+                data[spec['name']] = np.frombuffer(buffer, dtype=np.dtype(spec['dtype']), count=self.num_rows, offset=spec['offset'])
+            else:
+                data[spec['name']] = pickle.loads(buffer[spec['offset']: spec['offset'] + spec['nbytes']])
+        return pd.DataFrame(data, index=pd.RangeIndex(self.num_rows), copy=False)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            # the file may still be mapped (windows), it lives in the temp directory and is cleaned up there
+            logger.warning(f"unable to remove shared table file {self.path}")
+
+
+def records_frame(rows):
+    """the dataframe of a table given as a list of records, tables that already are dataframes are returned as they are"""
+    if isinstance(rows, pd.DataFrame):
+        return rows
+    return pd.DataFrame.from_records(rows)
+
+
+def load_sandbox_table(table):
+    """build the dataframe for a table handed to the sandbox, either a SharedTable, a dataframe or a list of records"""
+    if isinstance(table, SharedTable):
+        return table.load()
+    return records_frame(table)
+
+
+@contextmanager
+def sandbox_tables(table_list):
+    """yield the tables to hand to the sandbox, large tables are written once into memory-mapped files 
+    (removed again on exit) and small ones are passed along as records"""
+    shared_tables = []
+    try:
+        handles = []
+        for rows in table_list:
+            if len(rows) >= SANDBOX_SHM_MIN_ROWS:
+                table = SharedTable.write(records_frame(rows))
+                shared_tables.append(table)
+                handles.append(table)
+            else:
+                handles.append(rows)
+        yield handles
+    finally:
+        for table in shared_tables:
+            table.remove()
+
+
+def same_values(values, expected):
+    """compare two columns element-wise, treating missing values as equal"""
+    values = pd.Series(values).reset_index(drop=True)
+    expected = pd.Series(expected).reset_index(drop=True)
+    if len(values) != len(expected):
+        return False
+    try:
+        equal = (values == expected) | (values.isna() & expected.isna())
+        return bool(equal.all())
+    except Exception:
+        return False
+
+
+def apply_derive(derive, df, field_names, validation_rows=DERIVE_VALIDATION_ROWS):
+    """apply derive(*field values) to every row of df, returns (new column, strategy), runs inside the sandbox.
+    Strategies are tried in order:
+      - 'vectorized': derive is called once with whole columns (works for arithmetic, .str/.dt based functions)
+      - 'elementwise': derive is mapped over plain column arrays with numpy.frompyfunc, no per-row Series is built
+      - 'rowwise': the original df.apply(..., axis=1)
+    the first two are only accepted if they reproduce the row-wise results on the first validation_rows rows."""
+
+    def derive_rowwise(frame):
+        return frame.apply(lambda r: derive(*[r[name] for name in field_names]), axis=1)
+
+    if len(df) == 0 or len(field_names) == 0:
+        return derive_rowwise(df), 'rowwise'
+
+    # errors on the validation sample are real errors of the derive function, let them surface
+    expected = derive_rowwise(df.head(validation_rows))
+
+    try:
+        with np.errstate(all='ignore'):
+            values = derive(*[df[name].copy() for name in field_names])
+        if isinstance(values, (pd.Series, np.ndarray)) and len(values) == len(df) \
+                and (not isinstance(values, pd.Series) or values.index.equals(df.index)):
+            values = pd.Series(np.asarray(values), index=df.index)
+            if same_values(values.head(validation_rows), expected):
+                return values, 'vectorized'
+    except Exception:
+        pass
+
+    try:
+        ufunc = np.frompyfunc(derive, len(field_names), 1)
+        values = ufunc(*[df[name].to_numpy(dtype=object) for name in field_names])
+        values = pd.Series(values, index=df.index).infer_objects()
+        if same_values(values.head(validation_rows), expected):
+            return values, 'elementwise'
+    except Exception:
+        pass
+
+    return derive_rowwise(df), 'rowwise'
+
+
+def apply_filter(df, filter_df=None, filter_row=None):
+    """filter df with either a whole-frame filter_df(df) -> boolean mask ('frame'), or, 
+    for code written against the row contract, filter_row(row, df) applied to every row ('rowwise').
+    Returns (filtered dataframe, strategy), runs inside the sandbox."""
+
+    if filter_df is not None:
+        mask = filter_df(df.copy())
+        if isinstance(mask, pd.Series):
+            mask = mask.reindex(df.index)
+        mask = pd.Series(np.asarray(mask), index=df.index).fillna(False).astype(bool)
+        return df[mask], 'frame'
+
+    if filter_row is None:
+        raise NameError("neither filter_df nor filter_row is defined")
+
+    if len(df) == 0:
+        return df, 'rowwise'
+    filter_boolean = df.apply(lambda r: filter_row(r, df), axis=1)
+    return df[filter_boolean], 'rowwise'
+
+
+def sandbox_namespace(**objects):
+    """globals for a sandboxed script: the given objects plus the helper functions scripts may call"""
+    return {'load_table': load_sandbox_table, 'apply_derive': apply_derive, 'apply_filter': apply_filter, **objects}
+
+
+def defined_functions(code):
+    """names of the top-level functions defined in code (parsed, not executed)"""
+    try:
+        return [node.name for node in ast.parse(code).body if isinstance(node, ast.FunctionDef)]
+    except SyntaxError:
+        return []
+
+
+def row_chunks(num_rows, chunk_rows=SANDBOX_CHUNK_ROWS, max_parallel=SANDBOX_MAX_PARALLEL_CHUNKS):
+    """split num_rows into at most max_parallel [start, stop) ranges of at least chunk_rows rows each,
+    small tables stay in one chunk"""
+    if num_rows <= chunk_rows or max_parallel <= 1:
+        return [(0, num_rows)]
+    size = max(chunk_rows, math.ceil(num_rows / max_parallel))
+    return [(start, min(start + size, num_rows)) for start in range(0, num_rows, size)]
+
+
+def run_rowwise_chunks_in_sandbox(code, df, chunks, chunk_exec_str):
+    """run row-wise code over row chunks of df in parallel sandbox workers. df is shared with all workers through 
+    one memory-mapped table, chunk_exec_str sees it as df and its rows [chunk_start, chunk_stop) as chunk, and must set 
+    output to a Series for the chunk; the chunk results are concatenated back in the original row order"""
+
+    import_str = "import pandas as pd\nimport json"
+
+    script_str = f'{import_str}\n\n{code}\n\ndf = load_table(table_rows)\nchunk = df.iloc[chunk_start:chunk_stop]\n{chunk_exec_str}'
+
+    table = SharedTable.write(df)
+    try:
+        def run_chunk(chunk):
+            return run_in_sandbox(script_str, sandbox_namespace(table_rows=table, chunk_start=chunk[0], chunk_stop=chunk[1]), 'output')
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            chunk_results = list(executor.map(run_chunk, chunks))
+    finally:
+        table.remove()
+
+    for result, (start, stop) in zip(chunk_results, chunks):
+        if result['status'] != 'ok':
+            return result
+        if not isinstance(result['content'], pd.Series) or len(result['content']) != stop - start:
+            return {'status': 'error', 'content': f"Error: TypeError - unexpected result from row chunk [{start}, {stop})"}
+
+    return {'status': 'ok', 'content': pd.concat([result['content'] for result in chunk_results])}
+
+
+def check_output_dataframe(result):
+    """results come back from the sandbox as dataframes or series (decoded by decode_result), 
+    check that the returned object is indeed a dataframe the server can serialize"""
+    if result['status'] == 'ok':
+        output_df = result['content']
+        if not isinstance(output_df, pd.DataFrame):
+            return {'status': 'error', 'content': f"Error: TypeError - the function should return a pandas DataFrame, got {type(output_df).__name__}"}
+        if not output_df.columns.is_unique:
+            return {'status': 'error', 'content': f"Error: ValueError - the output DataFrame has duplicate column names"}
+    return result
+
+
+sandbox_result_cache = LRUCache(max_items=SANDBOX_RESULT_CACHE_MAX_ITEMS, max_bytes=SANDBOX_RESULT_CACHE_MAX_BYTES) \
+    if SANDBOX_RESULT_CACHE_MAX_ITEMS > 0 else None
+
+
+def normalized_code_hash(code):
+    """hash of the code's syntax tree, so that comments and formatting do not matter"""
+    try:
+        normalized = ast.dump(ast.parse(code))
+    except SyntaxError:
+        normalized = code
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def result_nbytes(result):
+    content = result['content']
+    if isinstance(content, pd.DataFrame):
+        return int(content.memory_usage(index=True, deep=True).sum())
+    return len(str(content))
+
+
+def copy_result(result):
+    """callers may modify the result dataframe, cached results are handed out as copies"""
+    if isinstance(result['content'], pd.DataFrame):
+        return {**result, 'content': result['content'].copy()}
+    return dict(result)
+
+
+def input_frames(arg):
+    """tables of a sandbox entry point's argument that are given as lists of records are turned into dataframes,
+    once for both the fingerprint and the run (registered tables are left alone, their id is their fingerprint)"""
+    if getattr(arg, 'table_id', None) is not None:
+        return arg
+    if isinstance(arg, list) and len(arg) > 0 and isinstance(arg[0], list):
+        return [input_frames(table) for table in arg]
+    if isinstance(arg, list) and len(arg) > 0 and isinstance(arg[0], dict):
+        return pd.DataFrame.from_records(arg)
+    return arg
+
+
+def input_fingerprint(arg):
+    """fingerprint of an argument of a sandbox entry point (after input_frames): registered tables by their id, 
+    dataframes by an exact, row order sensitive hash of their values plus their columns and dtypes, lists of tables 
+    element-wise, anything else (field names) as it is. None when a table cannot be hashed exactly."""
+    from data_formulator.agents.agent_utils import table_content_hash
+
+    if getattr(arg, 'table_id', None) is not None:
+        return ['table_id', arg.table_id]
+    if isinstance(arg, pd.DataFrame):
+        content_hash = table_content_hash(arg)
+        if content_hash is None:
+            return None
+        return ['content', content_hash, [str(name) for name in arg.columns], [str(dtype) for dtype in arg.dtypes]]
+    if isinstance(arg, list) and len(arg) > 0 and isinstance(arg[0], (list, pd.DataFrame)):
+        fingerprints = [input_fingerprint(table) for table in arg]
+        return None if None in fingerprints else fingerprints
+    return arg
+
+
+def cache_results(run):
+    """decorator for the run_*_in_sandbox entry points, whose first argument is the code: results are cached by the 
+    normalized code plus fingerprints of the other arguments (input tables, field names), a hit skips the sandbox.
+    Runs whose input tables cannot be fingerprinted exactly are not cached.
+    Generated code is expected to be deterministic, so error results are cached as well, except for transient 
+    failures (timeouts, crashes, MemoryError) that do not follow from the code and inputs."""
+
+    @functools.wraps(run)
+    def wrapper(code, *args):
+        if sandbox_result_cache is None:
+            return run(code, *args)
+
+        args = [input_frames(arg) for arg in args]
+        fingerprints = [input_fingerprint(arg) for arg in args]
+        if None in fingerprints:
+            return run(code, *args)
+        key = (run.__name__, normalized_code_hash(code), json.dumps(fingerprints, default=str))
+
+        global num_coalesced_runs
+        with _pending_runs_lock:
+            result = sandbox_result_cache.get(key)
+            if result is None:
+                # identical runs already in flight (e.g. two candidates with the same code) wait for the first one
+                pending = _pending_runs.get(key)
+                owner = pending is None
+                if owner:
+                    pending = _pending_runs[key] = Future()
+                else:
+                    num_coalesced_runs += 1
+
+        if result is not None:
+            logger.info(f"{run.__name__}: reusing the cached result")
+        elif owner:
+            try:
+                result = run(code, *args)
+                if not result.get('transient'):
+                    sandbox_result_cache.put(key, result, result_nbytes(result))
+                pending.set_result(result)
+            except BaseException as err:
+                pending.set_exception(err)
+                raise
+            finally:
+                with _pending_runs_lock:
+                    del _pending_runs[key]
+        else:
+            result = pending.result()
+        return copy_result(result)
+    return wrapper
+
+
+_pending_runs = {}
+_pending_runs_lock = threading.Lock()
+num_coalesced_runs = 0
+
+def sandbox_result_cache_stats():
+    if sandbox_result_cache is None:
+        return None
+    return {**sandbox_result_cache.stats(), "coalesced": num_coalesced_runs}
+
+
+@cache_results
 def run_transform_in_sandbox2020(code, table_list):
     
-    allowed_objects = [table_list]
-
     import_str = "import pandas as pd\nimport json"
 
     exec_str = '''
-output_df = transform_data(*[pd.DataFrame.from_records(data) for data in table_list])
+output_df = transform_data(*[load_table(data) for data in table_list])
 #print(output_df)
-output = output_df.to_json(None, "records")
+output = output_df
 #print(output)
     '''
 
     script_str = f'{import_str}\n\n{code}{exec_str}'
 
-    sandbox_locals = dict((key, value) for key,value in locals().items() if value in allowed_objects) # copy.deepcopy() ## are all obj safely serialized?
-    parent_conn, child_conn = Pipe()
-    p = Process(target=ran_in_subprocess, args=(script_str, sandbox_locals, child_conn, 'output'))
-    p.start()
-
-    ## NOTE: The sandbox is probably safe against file writing, as well as against access into the main process.
-    ## Yet the objects returned from it as results could have been manipulated. Asserting the output objects to be 
-    ## of expected data types is an extra safety measure. But be careful whenever your main program flow is 
-    ## controlled by the returned objects' attributes, e.g. file paths could change. 
-    result = parent_conn.recv()
-    p.join()
-    return result
+    with sandbox_tables(table_list) as tables:
+        result = run_in_sandbox(script_str, sandbox_namespace(table_list=tables), 'output')
+    return check_output_dataframe(result)
 
 
 def run_data_process_in_sandbox(code, table_rows, exec_str):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe,
+    exec_str should build the input dataframe with load_table(table_rows)"""
     
-    allowed_objects = [table_rows]
-
     import_str = "import pandas as pd\nimport json"
 
     script_str = f'{import_str}\n\n{code}{exec_str}'
 
-    sandbox_locals = dict((key, value) for key,value in locals().items() if value in allowed_objects) # copy.deepcopy() ## are all obj safely serialized?
-    parent_conn, child_conn = Pipe()
-    p = Process(target=ran_in_subprocess, args=(script_str, sandbox_locals, child_conn, 'output'))
-    p.start()
-
-    result = parent_conn.recv()
-    p.join()
-    return result
+    with sandbox_tables([table_rows]) as tables:
+        result = run_in_sandbox(script_str, sandbox_namespace(table_rows=tables[0]), 'output')
+    return check_output_dataframe(result)
 
+@cache_results
 def run_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
-    
-    arg_list = ", ".join([f'r["{name}"]' for name in field_names])
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe,
+    the execution strategy picked by apply_derive is reported in result['strategy']"""
 
     exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
-app_func = lambda r: derive({arg_list})
-df["{output_field_name}"] = df.apply(app_func, axis = 1)
-output = df.to_json(None, "records")
+df = load_table(table_rows)
+df[{output_field_name!r}], strategy = apply_derive(derive, df, {list(field_names)!r})
+df.attrs["strategy"] = strategy
+output = df
 #print(output)
     '''
 
-    return run_data_process_in_sandbox(code, table_rows, exec_str)
+    result = run_data_process_in_sandbox(code, table_rows, exec_str)
+    if result['status'] == 'ok':
+        result['strategy'] = result['content'].attrs.pop("strategy", None)
+    return result
 
 
 
+@cache_results
 def run_generic_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe,
+    large tables are processed in parallel row chunks (result['strategy'] is then 'chunked')"""
+
+    chunks = row_chunks(len(table_rows))
+    if len(chunks) > 1:
+        df = records_frame(table_rows)
+        result = run_rowwise_chunks_in_sandbox(code, df, chunks, "output = chunk.apply(lambda r: derive(r, df), axis = 1)")
+        if result['status'] == 'ok':
+            df[output_field_name] = result['content']
+            result = {'status': 'ok', 'content': df, 'strategy': 'chunked'}
+        return result
     
     exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
+df = load_table(table_rows)
 app_func = lambda r: derive(r, df)
-df["{output_field_name}"] = df.apply(app_func, axis = 1)
-output = df.to_json(None, "records")
+df[{output_field_name!r}] = df.apply(app_func, axis = 1)
+output = df
 #print(output)
     '''
 
-    return run_data_process_in_sandbox(code, table_rows, exec_str)
+    result = run_data_process_in_sandbox(code, table_rows, exec_str)
+    if result['status'] == 'ok':
+        result['strategy'] = 'rowwise'
+    return result
 
 
 
+@cache_results
 def run_filter_data_in_sandbox2020(code, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+    """given a filter function, either filter_df(df) or filter_row(row, df), execute it on inputs to generate the filtered dataframe,
+    the contract used is reported in result['strategy'], row-wise filters on large tables run in parallel row chunks"""
 
-    exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
-filter_fn = lambda r: filter_row(r, df)
-filter_boolean = df.apply(filter_fn, axis=1)
+    chunks = row_chunks(len(table_rows))
+    if len(chunks) > 1 and "filter_df" not in defined_functions(code):
+        df = records_frame(table_rows)
+        result = run_rowwise_chunks_in_sandbox(code, df, chunks, "output = chunk.apply(lambda r: filter_row(r, df), axis=1)")
+        if result['status'] == 'ok':
+            result = {'status': 'ok', 'content': df[result['content'].astype(bool)], 'strategy': 'chunked'}
+        return result
 
-df_out = df[filter_boolean]
+    exec_str = f'''
+df = load_table(table_rows)
+df_out, strategy = apply_filter(df, globals().get("filter_df"), globals().get("filter_row"))
+df_out.attrs["strategy"] = strategy
 
-output = df_out.to_json(None, "records")
+output = df_out
 #print(output)
     '''
 
-    return run_data_process_in_sandbox(code, table_rows, exec_str)
\ No newline at end of file
+    result = run_data_process_in_sandbox(code, table_rows, exec_str)
+    if result['status'] == 'ok':
+        result['strategy'] = result['content'].attrs.pop("strategy", None)
+    return result
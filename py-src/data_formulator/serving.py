@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Production serving for data formulator (python -m data_formulator --production).
+
+gunicorn runs the app in several worker processes with gthread workers. Windows, where gunicorn is not available, falls
+back to waitress. Install the serving dependencies with `pip install data_formulator[server]`.
+
+gevent workers (--worker-class gevent) let LLM requests wait on cooperative sockets instead of holding an OS thread each,
+but anything that blocks without yielding stalls every request of the worker: the sandbox round trip (multiprocessing
+pipes are plain blocking reads and writes, gevent does not patch them), building dataframes from large tables and
+encoding large responses. Sandbox workers are started (multiprocessing fork) after gevent has monkey-patched the
+worker, their children inherit the patched modules but only ever run the sandbox loop.
+
+This module doubles as the gunicorn config module, see the hooks at the bottom. It must not import the app at module
+level: gevent workers import the app themselves, after gevent has patched the standard library."""
+
+import importlib.util
+import os
+import signal
+import sys
+from pathlib import Path
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", min(4, os.cpu_count() or 1)))
+# threads per worker (gthread workers and waitress), one per request being served. Agent requests spend nearly all their
+# time waiting on the LLM provider or the sandbox processes with the GIL released, so idle threads are cheap. The default
+# leaves room above ADMISSION_MAX_ACTIVE (32 agent requests running at once per process) for requests waiting in the
+# admission queue and for short requests that are not admission-controlled (table registration, stats). With fewer
+# threads, requests wait in gunicorn's backlog instead, where admission control cannot see, order or reject them.
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 64))
+# concurrent requests per gevent worker
+SERVER_WORKER_CONNECTIONS = int(os.getenv("SERVER_WORKER_CONNECTIONS", 1000))
+# a worker silent for this many seconds is restarted, agent requests can legitimately take minutes
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", 300))
+# on SIGTERM, in-flight requests get this many seconds to finish (gunicorn only, see serve_waitress)
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+# workers are replaced after this many requests (plus some jitter) so that memory cannot grow without bound, 0 disables
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", 1000))
+
+WORKER_CLASSES = ["gthread", "gevent"]
+
+
+def has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def add_server_arguments(parser):
+    group = parser.add_argument_group("production serving (--production)")
+    group.add_argument("--production", action="store_true", help="Serve with gunicorn (waitress on Windows) instead of the development server, implies --no-browser")
+    group.add_argument("--workers", type=int, default=SERVER_WORKERS, help="Number of worker processes")
+    group.add_argument("--worker-class", choices=WORKER_CLASSES, default="gthread", help="gunicorn worker type, gevent only pays off for mostly LLM-bound traffic (see data_formulator.serving)")
+    group.add_argument("--threads", type=int, default=SERVER_THREADS, help="Threads per worker (gthread workers and waitress)")
+    group.add_argument("--worker-connections", type=int, default=SERVER_WORKER_CONNECTIONS, help="Concurrent requests per gevent worker")
+    group.add_argument("--timeout", type=int, default=SERVER_TIMEOUT, help="Seconds before a silent worker is restarted")
+    group.add_argument("--graceful-timeout", type=int, default=SERVER_GRACEFUL_TIMEOUT, help="Seconds in-flight requests get to finish on shutdown (gunicorn only, waitress does not wait for them)")
+    group.add_argument("--max-requests", type=int, default=SERVER_MAX_REQUESTS, help="Requests after which a worker is replaced (0 disables)")
+
+
+def gunicorn_command(args):
+    worker_class = args.worker_class
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--config", f"python:{__name__}",
+        "--pythonpath", str(Path(__file__).parent.parent),
+        "--bind", f"{args.host}:{args.port}",
+        "--workers", str(args.workers),
+        "--worker-class", worker_class,
+        "--timeout", str(args.timeout),
+        "--graceful-timeout", str(args.graceful_timeout),
+    ]
+    if worker_class == "gevent":
+        command += ["--worker-connections", str(args.worker_connections)]
+    else:
+        command += ["--threads", str(args.threads)]
+    if args.max_requests > 0:
+        command += ["--max-requests", str(args.max_requests), "--max-requests-jitter", str(max(1, args.max_requests // 10))]
+    return command + ["data_formulator.app:app"]
+
+
+def serve(args):
+    """serve the app in production mode, with gunicorn this replaces the current process and does not return"""
+    if sys.platform != "win32" and has_module("gunicorn"):
+        command = gunicorn_command(args)
+        logger.info(f"starting gunicorn: {' '.join(command[1:])}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # exec, so that the gunicorn master does not keep a copy of the app loaded by this process
+        os.execv(sys.executable, command)
+
+    if has_module("waitress"):
+        serve_waitress(args)
+        return
+
+    raise SystemExit("production serving needs gunicorn (or waitress on Windows): pip install data_formulator[server]")
+
+
+def serve_waitress(args):
+    """serve with waitress until SIGTERM or Ctrl+C. Shutdown is not graceful: waitress stops its event loop right away,
+    so requests still in flight are dropped (clients see the connection close) rather than drained, and
+    --graceful-timeout does not apply. Stop routing traffic to the server (e.g. at the load balancer) before stopping it."""
+    from waitress import create_server
+    from data_formulator.app import app
+
+    server = create_server(app, host=args.host, port=args.port, threads=args.threads, channel_timeout=args.timeout)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info(f"serving on http://{args.host}:{args.port} with waitress ({args.threads} threads)")
+    warm_up_worker()
+    try:
+        server.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+        shut_down_worker()
+
+
+def warm_up_worker():
+    from data_formulator import py_sandbox
+    from data_formulator.app import refresh_available_models
+    import threading
+
+    sandbox_pool = py_sandbox.get_sandbox_pool()
+    if sandbox_pool is not None:
+        sandbox_pool.warm_up()
+
+    if os.getenv("MODEL_CHECK_WARMUP", "false").lower() == "true":
+        threading.Thread(target=refresh_available_models, daemon=True).start()
+
+
+def shut_down_worker():
+    from data_formulator import py_sandbox
+
+    sandbox_pool = py_sandbox.get_sandbox_pool()
+    if sandbox_pool is not None:
+        sandbox_pool.shutdown()
+
+
+# gunicorn hooks, every worker has its own sandbox pool (SANDBOX_POOL_SIZE workers each)
+
+def post_worker_init(worker):
+    warm_up_worker()
+
+
+def worker_exit(server, worker):
+    shut_down_worker()
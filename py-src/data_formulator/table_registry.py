@@ -0,0 +1,97 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import hashlib
+import json
+import os
+import sys
+
+from data_formulator.cache_utils import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# memory budget of the registry, tables are held as decoded rows and counted by their estimated in-memory size
+TABLE_REGISTRY_MAX_BYTES = int(os.getenv("TABLE_REGISTRY_MAX_BYTES", 512 * 1024 * 1024))
+
+
+class TableNotFoundError(KeyError):
+    """raised when a request references tables that are not (or no longer) registered, the client should re-upload them"""
+
+    def __init__(self, table_ids):
+        super().__init__(f"tables not found: {', '.join(table_ids)}")
+        self.table_ids = table_ids
+
+
+class RegisteredRows(list):
+    """rows of a registered table, tagged with the table id so that caches downstream can key on it"""
+
+    def __init__(self, rows, table_id):
+        super().__init__(rows)
+        self.table_id = table_id
+
+
+def rows_nbytes(rows, sample_size=200):
+    """estimated memory held by a list of records (the list, the row dicts and their values), from a sample of rows.
+    Keys are left out, json decoding shares them between rows."""
+    if len(rows) == 0:
+        return sys.getsizeof(rows)
+    step = max(1, len(rows) // sample_size)
+    sample = rows[::step]
+    sample_nbytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values()) for row in sample)
+    return sys.getsizeof(rows) + sample_nbytes * len(rows) // len(sample)
+
+
+class TableRegistry(object):
+    """server-side store of uploaded tables, content-addressed by a fingerprint of their rows
+    so that agent requests can reference tables by id instead of posting the rows again.
+    Tables are held as decoded rows, so resolving them costs nothing, and are shared by every request that resolves 
+    them (callers must not modify the rows). Least recently used tables are evicted once the memory budget is exceeded."""
+
+    def __init__(self, max_bytes=TABLE_REGISTRY_MAX_BYTES):
+        self.tables = LRUCache(max_bytes=max_bytes)
+
+    def register(self, rows):
+        """store rows (json records), returns the table id"""
+        serialized = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+        table_id = hashlib.sha256(serialized).hexdigest()
+        if table_id not in self.tables:
+            nbytes = rows_nbytes(rows)
+            if not self.tables.put(table_id, RegisteredRows(rows, table_id), nbytes):
+                raise ValueError(f"table of about {nbytes} bytes exceeds the registry budget of {self.tables.max_bytes} bytes")
+            logger.info(f"registered table {table_id} ({len(rows)} rows, about {nbytes} bytes)")
+        else:
+            # refresh its position in the LRU order
+            self.tables.get(table_id)
+        return table_id
+
+    def get(self, table_id):
+        rows = self.tables.get(table_id)
+        if rows is None:
+            raise TableNotFoundError([table_id])
+        return rows
+
+    def resolve_input_tables(self, input_tables):
+        """input tables are either {"name": ..., "rows": [...]} or {"name": ..., "table_id": ...},
+        return them all in the {"name": ..., "rows": [...]} form"""
+        resolved = []
+        missing_ids = []
+        for table in input_tables:
+            if "rows" in table or "table_id" not in table:
+                resolved.append(table)
+                continue
+            rows = self.tables.get(table["table_id"])
+            if rows is None:
+                missing_ids.append(table["table_id"])
+                continue
+            resolved.append({**table, "rows": rows})
+        if len(missing_ids) > 0:
+            raise TableNotFoundError(missing_ids)
+        return resolved
+
+    def stats(self):
+        return self.tables.stats()
+
+
+table_registry = TableRegistry()
@@ -301,6 +301,14 @@ export const EncodingBox: FC<EncodingBoxProps> = function EncodingBox({ channel,
                             tmpConcept.levels = sortRes;
 
                             dispatch(dfActions.updateConceptItems(tmpConcept));
+
+                            if (candidate['truncated']) {
+                                dispatch(dfActions.addMessages({
+                                    "timestamp": Date.now(),
+                                    "type": "info",
+                                    "value": `${field?.name} has too many values to sort them all: only the first ones were sorted, the rest keep their original order.`
+                                }));
+                            }
                         }
                     }
                 } else {